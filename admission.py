@@ -0,0 +1,90 @@
+#
+# Admission control for the command stream
+#
+# Commands are only queued while the worker is keeping up.  Otherwise the
+# caller is told at once to come back later, rather than queueing behind the
+# backlog and timing out.
+#
+
+import os
+import time
+
+from command_stream import queue_status
+
+
+# Commands pending before new ones are refused with a 429
+queue_limit = int(os.environ.get("COMMAND_QUEUE_LIMIT", "100"))
+# Seconds the oldest pending command may wait without the worker finishing any
+# command before it is considered stalled, and new commands are refused with a
+# 503
+stall_after = float(os.environ.get("COMMAND_STALL_SECONDS", "5"))
+# Seconds to suggest in Retry-After
+retry_after = int(os.environ.get("COMMAND_RETRY_AFTER", "1"))
+
+rejected = {429: 0, 503: 0}
+
+
+class Overloaded(Exception):
+    """
+    The worker can't take another command right now.
+    """
+
+    def __init__(self, status, message, depth):
+        super().__init__(message)
+        self.status = status
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+def admit():
+    """
+    Raise `Overloaded` if a new command shouldn't be queued.
+
+    Returns the number of commands already pending.
+    """
+    (depth, processed_at, pending_at) = queue_status()
+    if depth >= queue_limit:
+        rejected[429] += 1
+        raise Overloaded(
+            429,
+            f"{depth} commands are already waiting.  Please try again.",
+            depth,
+        )
+    # The worker is only behind since the later of its last finished command,
+    # and the queue last filling up after it was empty
+    since = max(
+        (t for t in (processed_at, pending_at) if t is not None),
+        default=None,
+    )
+    idle = time.time() - since if since is not None else None
+    if depth and (idle is None or idle > stall_after):
+        rejected[503] += 1
+        raise Overloaded(
+            503,
+            "The worker is not processing commands.  Please try again.",
+            depth,
+        )
+    return depth
+
+
+def timed_out(depth):
+    """
+    The `Overloaded` for a command whose result never arrived.
+    """
+    rejected[503] += 1
+    return Overloaded(
+        503,
+        "Timed out waiting for the worker.  Please try again.",
+        depth,
+    )
+
+
+def metrics():
+    (depth, processed_at, pending_at) = queue_status()
+    return {
+        "depth": depth,
+        "limit": queue_limit,
+        "processed_at": processed_at,
+        "pending_at": pending_at,
+        "rejected": dict(rejected),
+    }
@@ -1,82 +1,293 @@
+import asyncio
 import litestar
 from litestar.config.cors import CORSConfig
 
+import admission
+from admission import Overloaded
+from cache import LRUCache
 from command_stream import insert_command
-from command_stream import wait_for_result
+from command_stream import read_result
+from command_stream import watch_results
 import database
+from dispatch import ResultDispatcher
+import base64
+import contextlib
+import datetime
 from functools import wraps
+from itertools import dropwhile
+from itertools import groupby
+from itertools import islice
 from typing import Optional
-import time
+import json
+import os
 import random
 
 from errors import _ok
 from errors import _exception
 from errors import _fail
 from errors import _error
+from history import History
+from history import diff
+from history import diff_under
+from history import path_key
+from history import resolve_path
+from main_loop import cmds
+from mirror import StateMirror
+import projection
+from schemas import SchemaError
+from sock import command_channel
+import tracing
 from utils import get_path
-from utils import flat_diff
+from utils import UNSET
 
 
-undo_predecessors = {}
+history = History(database.keep)
+
+# Decoded checkpoints, keyed by (slot, write timestamp), so that an entry is
+# never served once its slot has been reused.  Callers share the cached
+# values, and must not modify them.
+checkpoint_cache = LRUCache(
+    int(os.environ.get("CHECKPOINT_CACHE_SIZE", "64")),
+    int(os.environ.get("CHECKPOINT_CACHE_BYTES", str(64 * 1024 * 1024))),
+)
+
+
+def read_checkpoint(k=None):
+    """
+    Like `database.read`, but served from `checkpoint_cache` when possible.
+    """
+    if k is None:
+        k = database.get_checkpoint()
+    if k is None:
+        return {}
+    # A checkpoint's state and timestamp are written together.  Reading the
+    # timestamp first means a rewrite in between can only cache the newer
+    # state under the old key, which is never asked for again, rather than
+    # the old state under the new key
+    key = (k, database.get_timestamp(k))
+    found = checkpoint_cache.get(key)
+    if found is None:
+        encoded = database.read_encoded(k)
+        found = json.loads(encoded or "null")
+        if key[1] is not None and found is not None:
+            checkpoint_cache.put(key, found, len(encoded))
+    return found
+
+
+def read_current():
+    k = database.get_checkpoint()
+    return (k, read_checkpoint(k))
+
+
+# The current state, kept up to date by change notifications
+mirror = StateMirror(read_current, database.watch_checkpoint)
+
+# Command results, delivered as they are stored
+results = ResultDispatcher(read_result, watch_results)
+
+# Seconds to wait for a command's result, as `wait_for_result` does
+result_timeout = 5
+
+
+def snapshot(k):
+    """
+    Return checkpoint `k` as a frozen snapshot.
+
+    Snapshots are built from the checkpoint's stored delta on top of its
+    predecessor's snapshot where possible, so that they share structure and
+    can be diffed without walking the unchanged parts.
+    """
+    stamp = database.get_timestamp(k)
+    found = history.get(k, stamp)
+    if found is None:
+        base = database.predecessor(k)
+        base_stamp = None if base is None else database.get_timestamp(base)
+        found = history.record(
+            k,
+            read_checkpoint(k),
+            changed=database.read_delta(k),
+            # A base slot without a timestamp holds nothing to build on
+            base=None if base_stamp is None else base,
+            stamp=stamp,
+            base_stamp=base_stamp,
+        )
+    return found
+
+
+def checkpoint_at(at):
+    """
+    Return the checkpoint that was current at `at`, a Unix timestamp or an
+    ISO 8601 date and time, or None if there was none yet.
+    """
+    try:
+        ts = float(at)
+    except ValueError:
+        ts = datetime.datetime.fromisoformat(at).timestamp()
+    return database.checkpoint_at(ts)
+
+
+def queue_command(command, trace):
+    """
+    Validate `command` against its schema and hand it to the worker, along
+    with its `trace`.
+
+    Returns the key its result will be stored under, and the number of
+    commands queued ahead of it.  Malformed commands raise `SchemaError`,
+    before they ever reach the stream, and everything raises `Overloaded`
+    while the worker is overloaded (see `admission`).
+    """
+    with trace.span("http.validate"):
+        normalized = cmds.normalize(command)
+    with trace.span("http.admit"):
+        depth = admission.admit()
+    entry = tracing.carried(normalized, trace)
+    return (insert_command(entry, cmds.lane(normalized)), depth)
+
+
+def traced_response(command, result, trace, show_trace):
+    """
+    The response for a command's stored `result`.
+
+    The result's trace, as completed by the worker, takes over from `trace`,
+    and gets a last span for the result's way back to us.  It is exported,
+    and included in the response with `show_trace`.
+    """
+    (result, stored) = tracing.detach(result)
+    trace = stored or trace
+    trace.add("http.result", trace.end)
+    tracing.export(trace, command=command.get("command"))
+    response = _ok(result)
+    if show_trace:
+        response["trace"] = trace.to_json()
+    return response
+
+
+async def submit_command(command, show_trace=False, queueing=None):
+    """
+    Queue `command` (see `queue_command`), and await its result as `results`
+    delivers it.
+
+    Commands submitted with the same `queueing` lock are queued in the order
+    they ask for it, while their results are awaited concurrently.
+    """
+    trace = tracing.Trace()
+    try:
+        async with queueing or contextlib.nullcontext():
+            (key, depth) = await asyncio.to_thread(
+                queue_command, command, trace
+            )
+    except SchemaError as err:
+        return _error(command, str(err))
+    try:
+        result = await results.wait(key, result_timeout)
+    except TimeoutError:
+        raise admission.timed_out(depth + 1)
+    except Exception as err:
+        return _exception(err)
+    # Don't wait for the notification to see our own change
+    mirror.invalidate()
+    return traced_response(command, result, trace, show_trace)
+
+
+async def submit_pipelined(command, show_trace=False, queueing=None):
+    """
+    Like `submit_command`, but overloads are reported in the response, with
+    their HTTP status, rather than raised.
+    """
+    try:
+        return await submit_command(command, show_trace, queueing)
+    except Overloaded as exc:
+        return {
+            **_error({"queue_depth": exc.depth}, str(exc)),
+            "status": exc.status,
+            "retry_after": exc.retry_after,
+        }
+    except Exception as err:
+        return _exception(err)
+
+
+def overloaded(
+    request: litestar.Request,
+    exc: Overloaded,
+) -> litestar.Response:
+    return litestar.Response(
+        _error({"queue_depth": exc.depth}, str(exc)),
+        status_code=exc.status,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+async def restore_checkpoint(k):
+    """
+    Have the worker restore checkpoint `k`, which it does within storage.
+
+    Answers with the restored state, as the worker's `overwrite_state` used
+    to, but read through `checkpoint_cache`.
+    """
+    response = await submit_command(
+        {
+            "command": "restore_checkpoint",
+            "checkpoint": k,
+        }
+    )
+    outcome = response.get("result")
+    if response.get("ok") and isinstance(outcome, dict) and outcome.get("ok"):
+        try:
+            restored = outcome["result"]["checkpoint"]
+            outcome["result"] = read_checkpoint(restored)
+        except Exception as err:
+            return _exception(err)
+    return response
 
 
 @litestar.get("/")
 async def index() -> dict:
     try:
         return _ok("Hello, world!")
-    except Exception:
+    except Exception as err:
         return _exception(err)
 
 
 @litestar.post("/commands")
-async def issue_command(data: dict) -> dict:
+async def issue_command(data: dict, trace: bool = False) -> dict:
+    """
+    Run a command.  With `trace`, the response includes the command's trace:
+    its id, and how long it spent in each stage (see `tracing`).
+    """
     print(data)
-    key = insert_command(data)
-    try:
-        return _ok(wait_for_result(key))
-    except Exception as err:
-        return _exception(err)
+    return await submit_command(data, show_trace=trace)
 
 
 @litestar.get("/checkpoints")
 async def get_checkpoints() -> dict:
     try:
         return _ok(database.checkpoint_data())
-    except Exception:
+    except Exception as err:
         return _exception(err)
 
 
 @litestar.get("/checkpoint/{id_:int}")
 async def get_checkpoint(id_: int) -> dict:
     try:
-        return _ok(database.read(id_))
-    except Exception:
+        return _ok(read_checkpoint(id_))
+    except Exception as err:
         return _exception(err)
 
 
 @litestar.post("/checkpoint")
 async def set_checkpoint(data: int) -> dict:
     checkpoint_id = data
-    try:
-        checkpoint_data = database.read(checkpoint_id)
-        key = insert_command(
-            {
-                "command": "overwrite_state",
-                "state": checkpoint_data,
-            }
-        )
-        return _ok(wait_for_result(key))
-    except Exception as err:
-        return _exception(err)
+    return await restore_checkpoint(checkpoint_id)
 
 
 @litestar.get("/checkpoint/{id_:int}/diff")
 async def get_checkpoint_diff(id_: int, base: Optional[int] = None) -> dict:
     try:
-        base = base or database.roll(id_, -1)
-        previous = database.read(base)
-        current = database.read(id_)
-        diffed = list(flat_diff(previous, current))
+        base = base or database.predecessor(id_)
+        # Load the base first, so the target can be built on top of it
+        previous = snapshot(base)
+        current = snapshot(id_)
+        diffed = list(diff(previous, current))
         result = {
             "insertions": [
                 (x, a) for (op, x, a, *bs) in diffed if op == "insert"
@@ -93,46 +304,186 @@ async def get_checkpoint_diff(id_: int, base: Optional[int] = None) -> dict:
         return _exception(err)
 
 
+# Most changes returned by one page of a range diff
+max_diff_page = int(os.environ.get("DIFF_PAGE_LIMIT", "1000"))
+
+
+def _encode_cursor(path):
+    return base64.urlsafe_b64encode(json.dumps(path).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    return tuple(json.loads(base64.urlsafe_b64decode(cursor.encode())))
+
+
+def _diff_group(change):
+    path = change[1]
+    section = path[0] if path else None
+    entity = path[1] if section == "entities" and len(path) > 1 else None
+    return (section, entity)
+
+
+def _diff_json(change):
+    (op, path, *values) = change
+    result = {"op": op, "path": list(path)}
+    if op == "edit":
+        (result["old"], result["new"]) = values
+    elif op == "insert":
+        result["new"] = values[0]
+    else:
+        result["old"] = values[0]
+    return result
+
+
+@litestar.get("/checkpoints/diff")
+async def get_range_diff(
+    start: int,
+    end: int,
+    prefix: Optional[list[str]] = None,
+    entity: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+) -> dict:
+    """
+    The net changes from checkpoint `start` to checkpoint `end`, grouped by
+    top-level section and entity, a page at a time.
+
+    `prefix` (repeatable, "/"-separated, e.g. "entities/Rayne/stress") and
+    `entity` (short for the prefix "entities/<entity>") limit the changes to
+    those paths.  Pass the returned `cursor` to get the next page.
+    """
+    try:
+        old = snapshot(start)
+        new = snapshot(end)
+        for (k, found) in ((start, old), (end, new)):
+            if found is None:
+                return _error(k, f"No such checkpoint {k}")
+
+        parts = [p.strip("/").split("/") for p in prefix or []]
+        if entity is not None:
+            parts.append(["entities", entity])
+        prefixes = [resolve_path(p, old, new) for p in parts]
+
+        # The changes are generated in path order, and only as far as needed
+        # to fill this page
+        changes = diff_under(old, new, prefixes)
+        if cursor:
+            after = path_key(_decode_cursor(cursor))
+            changes = dropwhile(lambda c: path_key(c[1]) <= after, changes)
+        limit = max(1, min(limit, max_diff_page))
+        page = list(islice(changes, limit + 1))
+        more = len(page) > limit
+        page = page[:limit]
+
+        groups = [
+            {
+                "section": section,
+                "entity": name,
+                "changes": [_diff_json(c) for c in group],
+            }
+            for ((section, name), group) in groupby(page, key=_diff_group)
+        ]
+        return _ok(
+            {
+                "start": start,
+                "end": end,
+                "groups": groups,
+                "cursor": _encode_cursor(page[-1][1]) if more else None,
+            }
+        )
+    except Exception as err:
+        return _exception(err)
+
+
 @litestar.post("/undo")
 async def undo() -> dict:
     current = database.get_checkpoint()
-    pre = undo_predecessors.get(current, database.roll(current, -1))
+    pre = database.undo_target(current)
     post = database.roll(current, 1)
     # Wait to make sure there is no contention
-    time.sleep(1 + random.random())
+    await asyncio.sleep(1 + random.random())
     if database.get_checkpoint() != current:
         return _error(
             current,
             f"Can't undo while doing other operations.  Please try again.",
         )
 
-    undo_predecessors[post] = pre
+    # Kept in storage, so that every HTTP worker follows the same chain
+    database.set_undo_target(post, pre)
+
+    return await restore_checkpoint(pre)
+
 
+@litestar.get("/metrics")
+async def get_metrics() -> dict:
     try:
-        checkpoint_data = database.read(pre)
-        key = insert_command(
+        return _ok(
             {
-                "command": "overwrite_state",
-                "state": checkpoint_data,
+                "checkpoint_cache": checkpoint_cache.stats(),
+                "state_mirror": mirror.stats(),
+                "command_queue": admission.metrics(),
             }
         )
-        return _ok(wait_for_result(key))
     except Exception as err:
         return _exception(err)
 
 
 @litestar.get("/game")
-async def get_game() -> dict:
+async def get_game(
+    at: Optional[str] = None,
+    fields: Optional[list[str]] = None,
+    exclude: Optional[list[str]] = None,
+    entity: Optional[list[str]] = None,
+    is_pc: Optional[bool] = None,
+    has_stress: Optional[bool] = None,
+) -> dict:
+    """
+    The current state, or with `at`, the state as it was at that time.
+
+    `fields` and `exclude` (repeatable, "/"-separated paths in the stored
+    state, where "*" matches any key, e.g. "entities/*/stress") keep only
+    those parts, and then drop these.  `entity` (repeatable), `is_pc` and
+    `has_stress` (any stress box checked) keep only the matching entities.
+    """
     try:
-        result = database.read()
-        return _ok(result)
+        if at is None:
+            (_, result) = mirror.get()
+        else:
+            k = checkpoint_at(at)
+            if k is None:
+                return _error(at, f"No checkpoint at or before {at}")
+            result = read_checkpoint(k)
+        if (entity, is_pc, has_stress) != (None, None, None):
+            result = projection.filter_entities(
+                result, names=entity, is_pc=is_pc, has_stress=has_stress
+            )
+        # Empty paths would stand for the whole state, and are ignored
+        fields = [p for p in map(projection.parse_path, fields or []) if p]
+        exclude = [p for p in map(projection.parse_path, exclude or []) if p]
+        if fields:
+            result = projection.include(result, fields)
+        if exclude and result is not UNSET:
+            result = projection.exclude(result, exclude)
+        return _ok({} if result is UNSET else result)
     except Exception as err:
         return _exception(err)
 
 
 @litestar.get("/entity/{name:str}")
-async def get_entity(name: str) -> dict:
-    data = database.read()
+async def get_entity(name: str, at: Optional[str] = None) -> dict:
+    """
+    An entity as it is now, or with `at`, as it was at that time.
+    """
+    if at is None:
+        (_, data) = mirror.get()
+    else:
+        try:
+            k = checkpoint_at(at)
+        except Exception as err:
+            return _exception(err)
+        if k is None:
+            return _error(at, f"No checkpoint at or before {at}")
+        data = read_checkpoint(k)
     entity = get_path(data, ["entities", name], default=None)
     if entity is None:
         return _error(
@@ -146,41 +497,52 @@ async def get_entity(name: str) -> dict:
             return _exception(err)
 
 
-@litestar.post("/entity/{name:str}")
-async def post_entity(name: str, data: dict) -> dict:
-    cmd = {"command": "set_entity", "entity_value": data}
-    key = insert_command(cmd)
+@litestar.get("/entity/{name:str}/history")
+async def get_entity_history(name: str) -> dict:
+    """
+    Every recorded change to an entity, oldest first: the checkpoint and
+    time it was committed in, the command that made it, and the path within
+    the entity with its "old" and "new" values (each left out where absent).
+    """
     try:
-        return _ok(wait_for_result(key))
+        return _ok(database.entity_history(name))
     except Exception as err:
         return _exception(err)
 
 
+@litestar.post("/entity/{name:str}")
+async def post_entity(name: str, data: dict) -> dict:
+    cmd = {"command": "set_entity", "name": name, "entity_value": data}
+    return await submit_command(cmd)
+
+
 @litestar.post("/entity")
 async def create_entity(data: dict) -> dict:
     cmd = {"command": "create_entity", **data}
-    key = insert_command(cmd)
-    try:
-        return _ok(wait_for_result(key))
-    except Exception as err:
-        return _exception(err)
+    return await submit_command(cmd)
 
 
 routes = [
     index,
     issue_command,
+    command_channel(submit_pipelined),
     get_checkpoints,
     get_checkpoint,
     get_checkpoint_diff,
+    get_range_diff,
     set_checkpoint,
     get_game,
     get_entity,
+    get_entity_history,
     post_entity,
     create_entity,
     undo,
+    get_metrics,
 ]
 cors_config = CORSConfig(allow_origins=["*"])
 app = litestar.Litestar(
     route_handlers=routes,
     cors_config=cors_config,
+    exception_handlers={Overloaded: overloaded},
+    on_startup=[mirror.start, results.start],
 )
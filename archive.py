@@ -0,0 +1,128 @@
+import mmap
+import os
+import struct
+
+
+class Archive:
+    """
+    An append-only, on-disk store of encoded checkpoints.
+
+    Checkpoints are concatenated into a data file.  A separate index file
+    holds one fixed-size (offset, length, timestamp) record per checkpoint, so
+    entry `i` is found without scanning, and the entries can be listed without
+    touching the data.  Both files are read through `mmap`, and remapped when
+    they have grown.
+
+    Appending writes the data before its index record, so readers (in other
+    processes) only ever see complete entries.
+    """
+
+    record = struct.Struct("<QId")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.data_path = os.path.join(directory, "checkpoints.dat")
+        self.index_path = os.path.join(directory, "checkpoints.idx")
+        self._data = None
+        self._index = None
+
+    def _map(self, path, current, needed):
+        if current is not None and len(current) >= needed:
+            return current
+        # Open views into an old map keep it alive, so it is dropped rather
+        # than closed
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        try:
+            return os.path.getsize(self.index_path) // self.record.size
+        except FileNotFoundError:
+            return 0
+
+    def entry(self, i):
+        """
+        Return the (offset, length, timestamp) of entry `i`.
+        """
+        if not 0 <= i < len(self):
+            raise IndexError(f"No archived checkpoint {i}")
+        start = i * self.record.size
+        end = start + self.record.size
+        self._index = self._map(self.index_path, self._index, end)
+        return self.record.unpack_from(self._index, start)
+
+    def timestamp(self, i):
+        return self.entry(i)[2]
+
+    def view(self, i):
+        """
+        Return entry `i` as a memoryview into the mapped data file.
+        """
+        (offset, length, _) = self.entry(i)
+        self._data = self._map(self.data_path, self._data, offset + length)
+        return memoryview(self._data)[offset:offset + length]
+
+    def read_encoded(self, i):
+        return bytes(self.view(i))
+
+    def stamps(self):
+        """
+        Yield (i, timestamp) for every entry, newest first.
+        """
+        count = len(self)
+        if not count:
+            return
+        size = self.record.size
+        self._index = self._map(self.index_path, self._index, count * size)
+        for i in reversed(range(count)):
+            yield (i, self.record.unpack_from(self._index, i * size)[2])
+
+    def at(self, timestamp):
+        """
+        Return the index of the last entry archived at or before `timestamp`,
+        or None.
+
+        Entries are archived oldest first, so their timestamps are in order,
+        and the index is binary-searched in place.
+        """
+        count = len(self)
+        if not count:
+            return None
+        size = self.record.size
+        self._index = self._map(self.index_path, self._index, count * size)
+        (lo, hi) = (0, count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (_, _, ts) = self.record.unpack_from(self._index, mid * size)
+            if ts <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1 if lo else None
+
+    def append(self, encoded, timestamp):
+        """
+        Archive an encoded checkpoint, and return its index.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.data_path, "ab") as f:
+            offset = f.tell()
+            f.write(encoded)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.index_path, "ab") as f:
+            # Drop any torn record left by a crash mid-append
+            i = f.tell() // self.record.size
+            f.truncate(i * self.record.size)
+            f.seek(i * self.record.size)
+            f.write(self.record.pack(offset, len(encoded), timestamp))
+            f.flush()
+            os.fsync(f.fileno())
+        return i
+
+    def clear(self):
+        self._data = None
+        self._index = None
+        for path in (self.data_path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,127 @@
+from bisect import bisect_left
+from bisect import insort
+
+from tracking import changes
+
+
+def fold(name):
+    return name.casefold()
+
+
+class AspectIndex:
+    """
+    An entity's aspects, indexed for lookup.
+
+    Aspects are kept in insertion order (as an ordered set), so removals
+    don't shift a list.  Lookups by case-folded name or by kind are dict
+    hits, and substring lookups bisect into a sorted table of name suffixes,
+    so they cost time in proportion to the number of matches rather than the
+    number of aspects.
+    """
+
+    __slots__ = ("items", "by_name", "by_kind", "suffixes", "path")
+
+    def __init__(self, aspects=()):
+        self.path = None
+        self.items = {}
+        self.by_name = {}
+        self.by_kind = {}
+        self.suffixes = []
+        for aspect in aspects:
+            self._index(aspect)
+        self.suffixes.sort()
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def attach(self, path):
+        self.path = path
+
+    def touch(self):
+        changes.mark(self.path)
+
+    def _index(self, aspect, keep_sorted=False):
+        self.items[aspect] = None
+        aspect.owner = self
+        folded = fold(aspect.name)
+        if folded not in self.by_name:
+            self.by_name[folded] = {}
+            for i in range(len(folded)):
+                if keep_sorted:
+                    insort(self.suffixes, (folded[i:], folded))
+                else:
+                    self.suffixes.append((folded[i:], folded))
+        self.by_name[folded][aspect] = None
+        self.by_kind.setdefault(aspect.kind, {})[aspect] = None
+
+    def _unindex(self, aspect):
+        self.items.pop(aspect, None)
+        aspect.owner = None
+        folded = fold(aspect.name)
+        named = self.by_name.get(folded, {})
+        named.pop(aspect, None)
+        if not named:
+            self.by_name.pop(folded, None)
+            for i in range(len(folded)):
+                j = bisect_left(self.suffixes, (folded[i:], folded))
+                del self.suffixes[j]
+        of_kind = self.by_kind.get(aspect.kind, {})
+        of_kind.pop(aspect, None)
+        if not of_kind:
+            self.by_kind.pop(aspect.kind, None)
+
+    def get(self, name):
+        """
+        Return the aspects named `name`, ignoring case.
+        """
+        return list(self.by_name.get(fold(name), {}))
+
+    def of_kind(self, kind):
+        return list(self.by_kind.get(kind, {}))
+
+    def kinds(self):
+        return set(self.by_kind)
+
+    def matching(self, fragment):
+        """
+        Return the aspects whose names contain `fragment`, ignoring case.
+        """
+        fragment = fold(fragment)
+        found = {}
+        i = bisect_left(self.suffixes, (fragment,))
+        while i < len(self.suffixes):
+            (suffix, folded) = self.suffixes[i]
+            if not suffix.startswith(fragment):
+                break
+            found[folded] = True
+            i += 1
+        return [a for folded in found for a in self.by_name[folded]]
+
+    def add(self, aspect):
+        self._index(aspect, keep_sorted=True)
+        self.touch()
+
+    def remove(self, aspects):
+        for aspect in aspects:
+            if aspect in self.items:
+                self._unindex(aspect)
+                self.touch()
+
+    def keep_kinds(self, keep):
+        """
+        Remove every aspect whose kind is not in `keep`.
+        """
+        self.remove(
+            [
+                a
+                for kind in self.kinds()
+                if kind not in keep
+                for a in self.of_kind(kind)
+            ]
+        )
+
+    def to_json(self):
+        return [a.to_json() for a in self.items]
@@ -0,0 +1,150 @@
+"""
+Measure `GET /game` throughput against the HTTP tier with 1..N workers.
+
+For each worker count, starts `litestar run --wc <workers>` on a local port,
+has a number of client processes request `/game` as fast as they can for a
+while, and reports the requests served per second.  Throughput should grow
+with the workers up to the number of cores (clients included).
+
+Run from the repository root, e.g.
+
+    python benchmarks/http_load.py --workers 1,2,4 --clients 8
+
+Uses a throwaway SQLite database unless STORAGE_BACKEND is set.  Requires
+uvicorn, as `litestar run` does.
+"""
+import argparse
+import contextlib
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, root)
+
+if "STORAGE_BACKEND" not in os.environ:
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = os.path.join(
+        tempfile.mkdtemp(), "bench.sqlite3"
+    )
+
+import main_loop
+
+
+def setup(entities):
+    for i in range(entities):
+        main_loop.process_command(
+            {
+                "command": "create_entity",
+                "name": f"entity-{i}",
+                "stress_maxes": {"physical": 3, "mental": 2},
+            }
+        )
+
+
+def serve(port, workers):
+    server = subprocess.Popen(
+        [
+            "litestar",
+            "--app",
+            "app:app",
+            "run",
+            "--port",
+            str(port),
+            "--wc",
+            str(workers),
+        ],
+        cwd=root,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"litestar exited with {server.returncode}")
+        with contextlib.suppress(OSError):
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            return server
+        time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("litestar did not start")
+
+
+def client(port, seconds, counts):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    served = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        connection.request("GET", "/game")
+        response = connection.getresponse()
+        response.read()
+        if response.status == 200:
+            served += 1
+    counts.put(served)
+
+
+def run(port, workers, clients, seconds):
+    server = serve(port, workers)
+    try:
+        counts = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=client, args=(port, seconds, counts)
+            )
+            for _ in range(clients)
+        ]
+        for process in processes:
+            process.start()
+        served = sum(counts.get() for _ in processes)
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return served / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--workers",
+        default="1,2,4",
+        help="Comma-separated worker counts to run",
+    )
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--entities", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        setup(args.entities)
+
+    cores = os.cpu_count()
+    print(
+        f"{args.entities} entities, {args.clients} clients, {cores} cores, "
+        f"{args.seconds:g} s per run:"
+    )
+    baseline = None
+    for workers in [int(w) for w in args.workers.split(",")]:
+        if workers > cores:
+            # `litestar run` refuses more workers than cores
+            print(f"  {workers:>2} workers: skipped (only {cores} cores)")
+            continue
+        rate = run(args.port, workers, args.clients, args.seconds)
+        baseline = baseline or rate
+        print(
+            f"  {workers:>2} workers: {rate:>8.0f} req/s"
+            f"  ({rate / baseline:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
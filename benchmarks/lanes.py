@@ -0,0 +1,148 @@
+"""
+Measure `next` latency while a backlog of bulk commands is worked through.
+
+Runs a worker in-process, queues a backlog of bulk commands, and times
+interactive `next` commands submitted at a steady pace meanwhile, from
+submission to result.  First with everything queued in the interactive lane
+(as before there were lanes), then with the bulk commands in their own lane.
+
+Run from the repository root, e.g.
+
+    python benchmarks/lanes.py --entities 200 --bulk 200
+
+Uses a throwaway SQLite database unless STORAGE_BACKEND is set.
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+if "STORAGE_BACKEND" not in os.environ:
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = os.path.join(
+        tempfile.mkdtemp(), "bench.sqlite3"
+    )
+
+from command_stream import insert_command
+from command_stream import queue_status
+from command_stream import read_result
+import database
+from lanes import BULK
+from lanes import INTERACTIVE
+import main_loop
+
+
+def drain():
+    while queue_status()[0]:
+        time.sleep(0.01)
+
+
+def setup(entities):
+    for i in range(entities):
+        main_loop.process_command(
+            {
+                "command": "create_entity",
+                "name": f"entity-{i}",
+                "stress_maxes": {"physical": 3, "mental": 2},
+            }
+        )
+        main_loop.process_command(
+            {"command": "order_add", "entity": f"entity-{i}", "bonus": i}
+        )
+    main_loop.process_command({"command": "start_order"})
+
+
+def run(bulk_lane, bulk, samples, interval):
+    # Replacing the whole state is about the heaviest command there is
+    state = database.read()
+    for _ in range(bulk):
+        command = {"command": "overwrite_state", "state": state}
+        insert_command(command, bulk_lane)
+
+    # Submit `next` at a steady pace while the backlog is worked through,
+    # noting when each result turns up
+    pending = {}
+    latencies = []
+    next_at = time.perf_counter()
+    while len(latencies) < samples:
+        now = time.perf_counter()
+        if len(pending) + len(latencies) < samples and now >= next_at:
+            pending[insert_command({"command": "next"}, INTERACTIVE)] = now
+            next_at = now + interval
+        for (key, start) in list(pending.items()):
+            if read_result(key) is not None:
+                latencies.append(time.perf_counter() - start)
+                del pending[key]
+        time.sleep(0.001)
+
+    drain()
+    return latencies
+
+
+def report(label, latencies, out):
+    ordered = sorted(latencies)
+    p95 = ordered[int(len(ordered) * 0.95) - 1]
+    print(
+        f"{label:<28} median {statistics.median(ordered) * 1000:8.1f} ms"
+        f"  p95 {p95 * 1000:8.1f} ms  max {ordered[-1] * 1000:8.1f} ms",
+        file=out,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--entities", type=int, default=100)
+    parser.add_argument("--bulk", type=int, default=200)
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.05,
+        help="Seconds between `next` commands",
+    )
+    args = parser.parse_args()
+
+    out = sys.stdout
+    # The worker reports every command it runs
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        setup(args.entities)
+        worker = threading.Thread(
+            target=lambda: asyncio.run(main_loop.main_loop()),
+            daemon=True,
+        )
+        worker.start()
+        time.sleep(0.2)
+
+        runs = [
+            (
+                "single lane",
+                run(INTERACTIVE, args.bulk, args.samples, args.interval),
+            ),
+            (
+                "bulk lane",
+                run(BULK, args.bulk, args.samples, args.interval),
+            ),
+        ]
+
+    print(
+        f"{args.entities} entities, {args.bulk} bulk commands queued, "
+        f"{args.samples} samples of `next`:",
+        file=out,
+    )
+    for (label, latencies) in runs:
+        report(label, latencies, out)
+    out.flush()
+    # The worker's reader never returns, so don't wait for it
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
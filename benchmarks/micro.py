@@ -0,0 +1,436 @@
+"""
+Microbenchmarks for the core helpers and every registered command.
+
+Builds a synthetic campaign of each size, and times each helper and each
+command handler on its own against an in-memory `Game`: handlers are called
+through `__wrapped__`, bypassing `database.editing`, so nothing is read,
+committed or stored.  Reports the median time per call.
+
+Run from the repository root, e.g.
+
+    python benchmarks/micro.py --sizes 10,1000
+    python benchmarks/micro.py --save      # store the results as baselines
+    python benchmarks/micro.py --check     # fail on regressions against them
+
+Baselines are kept per size in micro_baseline.json next to this script.
+With --check, the exit status is 1 if any case is more than --threshold
+slower than its baseline.
+"""
+import argparse
+import contextlib
+from itertools import chain
+import json
+import os
+import statistics
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+# Nothing here touches storage, but importing `main_loop` makes a backend
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = ":memory:"
+
+from history import apply_changes
+from history import diff
+from main_loop import cmds
+from models import Game
+from persistent import freeze
+from utils import _flatten_struct
+from utils import flat_diff
+from utils import get_path
+
+
+baseline_path = os.path.join(here, "micro_baseline.json")
+
+# Entities in the turn order, however big the campaign
+order_size = 50
+
+# Helpers that are quadratic in the size of the state, and are skipped above
+# this many entities
+quadratic_limit = 5000
+
+
+#
+# Synthetic campaigns
+#
+
+
+def entity_name(i):
+    return f"entity-{i}"
+
+
+def campaign(entities):
+    """
+    A state with `entities` entities, a few of them in a running turn order.
+    """
+    state = {
+        "entities": {
+            entity_name(i): {
+                "name": entity_name(i),
+                "fate": 3,
+                "refresh": 3,
+                "aspects": [
+                    {"name": "Battered", "kind": "mild", "tags": 1},
+                    {"name": "Off Balance", "kind": "fragile", "tags": 1},
+                    {"name": "Grudge", "kind": "sticky", "tags": 0},
+                ],
+                "stress": {
+                    "physical": {"checked": [1], "max": 3},
+                    "mental": {"checked": [], "max": 2},
+                    "hunger": {"checked": [1], "max": 4},
+                },
+                "is_pc": i % 5 == 0,
+            }
+            for i in range(entities)
+        },
+        "order": None,
+    }
+    in_order = [entity_name(i) for i in range(min(entities, order_size))]
+    state["order"] = {
+        "entities": in_order,
+        "bonuses": {name: i for (i, name) in enumerate(in_order)},
+        "order": list(reversed(in_order)),
+        "current": 0,
+        "deferred": [],
+    }
+    return state
+
+
+#
+# Cases
+#
+
+
+def helper_cases(state, entities):
+    """
+    Yield (case, func, max calls) for each helper, or (case, None, reason)
+    for those skipped at this size.  `func` takes the call's index.
+    """
+    game = Game.from_json(state)
+    changed = json.loads(json.dumps(state))
+    changed["entities"][entity_name(0)]["fate"] = 0
+    snapshot = freeze(state)
+    path = ("entities", entity_name(0), "fate")
+    changed_snapshot = apply_changes(snapshot, changed, [path])
+
+    def deep(i):
+        name = entity_name(i % entities)
+        return get_path(state, ["entities", name, "stress", "physical", "max"])
+
+    yield ("get_path", deep, None)
+    yield (
+        "get_path (missing)",
+        lambda i: get_path(state, ["entities", "nobody", "fate"], None),
+        None,
+    )
+    if entities <= quadratic_limit:
+        yield ("_flatten_struct", lambda i: _flatten_struct(state), None)
+        yield ("flat_diff", lambda i: list(flat_diff(state, changed)), None)
+    else:
+        reason = f"quadratic, over {quadratic_limit} entities"
+        yield ("_flatten_struct", None, reason)
+        yield ("flat_diff", None, reason)
+    yield ("Game.from_json", lambda i: Game.from_json(state), None)
+    yield ("Game.to_json", lambda i: game.to_json(), None)
+    yield ("freeze", lambda i: freeze(state), None)
+    yield (
+        "apply_changes",
+        lambda i: apply_changes(snapshot, changed, [path]),
+        None,
+    )
+    yield (
+        "history.diff",
+        lambda i: list(diff(snapshot, changed_snapshot)),
+        None,
+    )
+
+
+def _entity_command(command, **args):
+    # Each call works on a different entity, so every call does the same
+    # work on an untouched entity, until they run out
+    return (
+        lambda i: {"command": command, "entity": entity_name(i), **args},
+        1,
+    )
+
+
+# Command name -> (arguments for call `i`, calls per entity, or None if any
+# number of calls can go to the same state)
+command_args = {
+    "create_entity": (
+        lambda i: {
+            "command": "create_entity",
+            "name": f"new-{i}",
+            "stress_maxes": {"physical": 3, "mental": 2},
+        },
+        None,
+    ),
+    "edit_entity": (
+        lambda i: {
+            "command": "edit_entity",
+            "name": entity_name(i),
+            "fate": 1,
+            "stress_maxes": {"physical": 4},
+        },
+        1,
+    ),
+    "set_entity": (
+        lambda i: {
+            "command": "set_entity",
+            "name": entity_name(i),
+            "entity_value": {"name": entity_name(i), "fate": 2},
+        },
+        1,
+    ),
+    "remove_entity": _entity_command("remove_entity"),
+    "set_portrait": _entity_command(
+        "set_portrait", portrait_url="https://example.com/p.png"
+    ),
+    "decrement_fp": _entity_command("decrement_fp"),
+    "increment_fp": _entity_command("increment_fp"),
+    "set_fp": _entity_command("set_fp", fp=5),
+    "refresh_fp": _entity_command("refresh_fp"),
+    "add_aspect": _entity_command("add_aspect", name="Inspired", tags=1),
+    "remove_aspect": _entity_command("remove_aspect", name="Grudge"),
+    "tag_aspect": _entity_command("tag_aspect", name="Battered"),
+    "clear_all_consequences": (
+        lambda i: {
+            "command": "clear_all_consequences",
+            "max_severity": "mild",
+        },
+        None,
+    ),
+    "clear_consequences": _entity_command(
+        "clear_consequences", max_severity="mild"
+    ),
+    "add_stress": _entity_command("add_stress", stress="physical", box=2),
+    "absorb_stress": _entity_command(
+        "absorb_stress", stress="mental", amount=1
+    ),
+    "clear_stress_box": _entity_command(
+        "clear_stress_box", stress="physical", box=1
+    ),
+    "order_add": _entity_command("order_add", bonus=1),
+    "drop_from_order": (
+        lambda i: {"command": "drop_from_order"},
+        None,
+    ),
+    "undefer": (
+        lambda i: {"command": "undefer", "entity": entity_name(i)},
+        1,
+    ),
+    # NPCs are 4 in 5 entities, so these touch most of the campaign
+    "bulk_add_stress": (
+        lambda i: {
+            "command": "bulk_add_stress",
+            "select": {"is_pc": False},
+            "stress": "physical",
+            "box": 2,
+        },
+        None,
+    ),
+    "bulk_absorb_stress": (
+        lambda i: {
+            "command": "bulk_absorb_stress",
+            "select": {"is_pc": False},
+            "stress": "mental",
+            "amount": 1,
+        },
+        None,
+    ),
+    "bulk_add_aspect": (
+        lambda i: {
+            "command": "bulk_add_aspect",
+            "select": {"in_order": True},
+            "name": f"Inspired {i}",
+        },
+        None,
+    ),
+    "bulk_set_fp": (
+        lambda i: {
+            "command": "bulk_set_fp",
+            "select": {"has_aspect": "Grudge"},
+            "fp": i % 5,
+        },
+        None,
+    ),
+    "bulk_refresh_fp": (
+        lambda i: {"command": "bulk_refresh_fp", "select": {"is_pc": True}},
+        None,
+    ),
+    "test": (lambda i: {"command": "test", "string": "bench"}, None),
+    "implicit_test": (
+        lambda i: {"command": "implicit_test", "string": "bench"},
+        None,
+    ),
+}
+
+
+def command_cases(state, entities):
+    """
+    Yield (case, func, max calls) for each registered command, or (case,
+    None, reason) for those that can't run without storage.
+    """
+    encoded = json.dumps(state)
+    for name in sorted(cmds.commands):
+        handler = cmds.get(name)
+        (args, per_entity) = command_args.get(
+            name, (lambda i, name=name: {"command": name}, None)
+        )
+        if name == "overwrite_state":
+            args = lambda i: {"command": "overwrite_state", "state": state}
+        calls = entities * per_entity if per_entity else None
+
+        inner = getattr(handler, "__wrapped__", None)
+        if inner is None and getattr(handler, "mutates", False):
+            yield (f"command {name}", None, "needs storage")
+            continue
+
+        # Each command gets a state of its own
+        data = json.loads(encoded)
+        if name == "undefer":
+            # All but the first in the order have deferred, so that each
+            # call has one to undo
+            order = data["order"]
+            (order["order"], order["deferred"]) = (
+                order["order"][:1],
+                order["order"][1:],
+            )
+            calls = len(order["deferred"])
+        game = {"data": Game.from_json(data)}
+        typed = [cmds.decode(args(i))[1] for i in range(calls or 1)]
+
+        if inner is not None:
+            func = lambda i, inner=inner, typed=typed, game=game: inner(
+                game, typed[i % len(typed)]
+            )
+        else:
+            func = lambda i, handler=handler, typed=typed: handler(
+                typed[i % len(typed)]
+            )
+        yield (f"command {name}", func, calls)
+
+
+#
+# Timing
+#
+
+
+def measure(func, max_calls, samples, budget):
+    """
+    Return the median time of up to `samples` calls of `func`, stopping
+    early once `budget` seconds are spent (after at least 3 calls).
+    """
+    limit = samples if max_calls is None else min(samples, max_calls)
+    times = []
+    started = time.perf_counter()
+    for i in range(limit):
+        start = time.perf_counter()
+        func(i)
+        end = time.perf_counter()
+        times.append(end - start)
+        if end - started > budget and len(times) >= 3:
+            break
+    return statistics.median(times)
+
+
+def run(entities, samples, budget, only):
+    state = campaign(entities)
+    results = {}
+    skipped = {}
+    # Generated one at a time, so only one command's state is held at once
+    cases = chain(
+        helper_cases(state, entities),
+        command_cases(state, entities),
+    )
+    for (case, func, limit) in cases:
+        if only and not any(o in case for o in only):
+            continue
+        if func is None:
+            skipped[case] = limit
+            continue
+        # Some handlers report what they do
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            results[case] = measure(func, limit, samples, budget) * 1e6
+    return (results, skipped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        default="10,1000,50000",
+        help="Comma-separated campaign sizes, in entities",
+    )
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=1.0,
+        help="Seconds to spend on each case, at most (after 3 calls)",
+    )
+    parser.add_argument(
+        "--only",
+        default="",
+        help="Comma-separated substrings: run only the matching cases",
+    )
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        help=f"Store the results as baselines, in {baseline_path}",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Compare the results with the stored baselines",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.3,
+        help="Relative slowdown counted as a regression by --check",
+    )
+    args = parser.parse_args()
+    only = [o for o in args.only.split(",") if o]
+
+    baselines = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    for entities in [int(s) for s in args.sizes.split(",")]:
+        (results, skipped) = run(entities, args.samples, args.budget, only)
+        base = baselines.get(str(entities), {})
+        print(f"{entities} entities:")
+        for (case, us) in results.items():
+            line = f"  {case:<40} {us:>12.1f} us"
+            if case in base:
+                ratio = us / base[case]
+                line += f"  {ratio:>5.2f}x baseline"
+                if args.check and ratio > 1 + args.threshold:
+                    regressions.append((entities, case, ratio))
+                    line += "  REGRESSION"
+            print(line)
+        for (case, reason) in skipped.items():
+            print(f"  {case:<40} skipped ({reason})")
+        if args.save:
+            rounded = {case: round(us, 1) for (case, us) in results.items()}
+            baselines[str(entities)] = {**base, **rounded}
+        sys.stdout.flush()
+
+    if args.save:
+        with open(baseline_path, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.threshold:.0%}:")
+        for (entities, case, ratio) in regressions:
+            print(f"  {entities} entities: {case} {ratio:.2f}x")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Compare the storage backends on the operations a command costs.
+
+Run from the repository root, e.g.
+
+    REDIS_PASSWORD=... python benchmarks/storage.py --entities 50
+
+Backends that can't be reached are skipped.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+# Keep `storage` from connecting its default backend on import; the
+# benchmarked backends are made below
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = ":memory:"
+
+import storage
+
+
+def synthetic_state(entities):
+    return {
+        "entities": {
+            f"entity-{i}": {
+                "name": f"entity-{i}",
+                "fate": 2,
+                "refresh": 3,
+                "aspects": [
+                    {"name": f"Aspect {j}", "kind": "mild", "tags": 1}
+                    for j in range(3)
+                ],
+                "stress": {
+                    "physical": {"checked": [1], "max": 3},
+                    "mental": {"checked": [], "max": 2},
+                },
+                "is_pc": i % 4 == 0,
+            }
+            for i in range(entities)
+        },
+        "order": None,
+    }
+
+
+def timed(label, n, func):
+    start = time.perf_counter()
+    for i in range(n):
+        func(i)
+    elapsed = time.perf_counter() - start
+    print(
+        f"  {label:<24} {n / elapsed:>10.0f} ops/s"
+        f"  {elapsed / n * 1e6:>9.1f} us/op"
+    )
+
+
+def bench(backend, n, encoded):
+    ids = []
+    delta = json.dumps([["entities", "entity-0", "fate"]])
+
+    timed(
+        "save_checkpoint",
+        n,
+        lambda i: backend.save_checkpoint(
+            i % 50, encoded, time.time(), delta
+        ),
+    )
+    timed("set_pointer", n, lambda i: backend.set_pointer(i % 50))
+    timed("load_checkpoint", n, lambda i: backend.load_checkpoint(i % 50))
+    timed(
+        "checkpoint_timestamp",
+        n,
+        lambda i: backend.checkpoint_timestamp(i % 50),
+    )
+    timed(
+        "checkpoint_stamps",
+        max(n // 10, 1),
+        lambda i: backend.checkpoint_stamps(),
+    )
+    timed(
+        "append_command",
+        n,
+        lambda i: ids.append(
+            backend.append_command(json.dumps({"command": "next"}))
+        ),
+    )
+    timed(
+        "read_commands",
+        n,
+        lambda i: backend.read_commands(ids[-2]),
+    )
+    timed(
+        "store_result",
+        n,
+        lambda i: backend.store_result(f"bench-{ids[i]}", encoded, 60),
+    )
+    timed("load_result", n, lambda i: backend.load_result(f"bench-{ids[i]}"))
+
+    # One whole command, as the worker and HTTP process see it
+    def command(i):
+        key = backend.append_command(json.dumps({"command": "next"}))
+        backend.read_commands(ids[-1])
+        ids.append(key)
+        backend.load_checkpoint(i % 50)
+        backend.save_checkpoint((i + 1) % 50, encoded, time.time(), delta)
+        backend.set_pointer((i + 1) % 50)
+        backend.store_result(key, encoded, 60)
+        backend.load_result(key)
+
+    timed("round trip (command)", n, command)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=1000)
+    parser.add_argument("--entities", type=int, default=20)
+    parser.add_argument(
+        "--backends",
+        default="redis,sqlite",
+        help="Comma-separated backends to run",
+    )
+    args = parser.parse_args()
+
+    encoded = json.dumps(synthetic_state(args.entities))
+    print(f"State size: {len(encoded)} bytes, {args.n} ops per test")
+
+    for kind in args.backends.split(","):
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                if kind == "sqlite":
+                    backend = storage.SqliteBackend(
+                        os.path.join(tmp, "bench.sqlite3")
+                    )
+                else:
+                    # Don't touch a live deployment's ring or queue
+                    backend = storage.RedisBackend(
+                        stream="bench-commands",
+                        pointer="bench-checkpoint",
+                        prefix="bench-",
+                    )
+                    backend.redis.ping()
+            except Exception as err:
+                print(f"{kind}: skipped ({err!r})")
+                continue
+            print(f"{kind}:")
+            bench(backend, args.n, encoded)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A least-recently-used cache, bounded both by its number of entries and by
+    the total `size` of the entries (as reported by whoever puts them).
+
+    Counts its hits and misses, for reporting.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size=0):
+        if size > self.max_bytes or self.max_entries < 1:
+            # Would evict everything else and still not fit
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while (
+            len(self.entries) > self.max_entries
+            or self.bytes > self.max_bytes
+        ):
+            (_, (_, evicted)) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
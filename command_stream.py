@@ -1,47 +1,70 @@
 import json
 import os
 
-from db_redis import redis
+from lanes import INTERACTIVE
+from storage import backend
 
 from utils import query_eventually
 
 
 RESULT_TTL = 3600
-command_stream = "commands"
 
 
-
-def wait_for_commands(last="$"):
-    result = redis.xread(streams={command_stream: last}, block=0)
-    entries = dict(result)
-    for (entry_id, entry) in entries[command_stream]:
-        yield (entry_id, json.loads(entry["data"]))
+def wait_for_commands(lasts):
+    for (lane, entry_id, data) in backend.read_commands(lasts):
+        yield (lane, entry_id, json.loads(data))
 
 
 def read_command_log():
-    result = redis.xrange(command_stream)
-    for (entry_id, entry) in result:
-        yield (entry_id, json.loads(entry["data"]))
+    for (lane, entry_id, data) in backend.command_log():
+        yield (lane, entry_id, json.loads(data))
+
+
+def result_key(lane, entry_id):
+    """
+    The key a command's result is stored under.  Entry ids are only unique
+    within a lane.
+    """
+    if lane == INTERACTIVE:
+        return entry_id
+    return f"{lane}:{entry_id}"
+
+
+def start_consuming():
+    return backend.start_consuming()
 
 
-def insert_command(command):
-    return redis.xadd(command_stream, {"data": json.dumps(command)})
+def queue_status():
+    return backend.queue_status()
+
+
+def insert_command(command, lane=INTERACTIVE):
+    entry_id = backend.append_command(json.dumps(command), lane)
+    return result_key(lane, entry_id)
 
 
 def store_result(data, key):
     print(f"Saving data to {key}: {data}", flush=True)
-    redis.set(key, json.dumps(data))
-    redis.expire(key, RESULT_TTL)
+    backend.store_result(key, json.dumps(data), RESULT_TTL)
 
 
 def read_result(key):
-    res = redis.get(key)
+    res = backend.load_result(key)
     if res:
         return json.loads(res)
     else:
         return None
 
 
+def watch_results():
+    """
+    Yield the key of each result as it is stored (see
+    `StorageBackend.watch_results`), or return None if the backend can't
+    tell.
+    """
+    return backend.watch_results()
+
+
 def wait_for_result(key):
 
     def _read_result():
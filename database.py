@@ -1,24 +1,40 @@
 from contextlib import contextmanager
+from contextvars import ContextVar
 import json
 import glob
 import os
 import re
 import datetime
 
-from db_redis import redis
+from archive import Archive
 from errors import _exception
+from history import History
+from history import entity_changes
+from models import Game
+from persistent import freeze
+from storage import backend
+from tracking import changes
+import tracing
 
 
-checkpoint = "persist-checkpoint"
-keep = 50
+# The hot tier: a ring of this many checkpoints in the storage backend
+keep = int(os.environ.get("CHECKPOINT_KEEP", "50"))
+
+# The cold tier: checkpoints pushed out of the ring are appended here, if set.
+# Archived checkpoint `i` is known by the id `archive_base + i`.
+archive_dir = os.environ.get("CHECKPOINT_ARCHIVE")
+archive = Archive(archive_dir) if archive_dir else None
+archive_base = 1000000
+if keep >= archive_base:
+    raise ValueError(f"Invalid: keep {keep} exceeds {archive_base}")
+
+
+def is_archived(k):
+    return k is not None and k >= archive_base
 
 
 def get_checkpoint():
-    chkpt = redis.get(checkpoint)
-    if chkpt is not None:
-        return int(chkpt)
-    else:
-        return None
+    return backend.get_pointer()
 
 
 def roll(k, amount):
@@ -27,33 +43,68 @@ def roll(k, amount):
     return (k + amount) % keep
 
 
+def predecessor(k):
+    """
+    Return the checkpoint written before `k`, as far as can be told.
+    """
+    if is_archived(k):
+        return k - 1 if k > archive_base else None
+    return roll(k, -1)
+
+
+def watch_checkpoint():
+    """
+    Yield each time the current checkpoint may have changed (see
+    `StorageBackend.watch_pointer`), or return None if the backend can't
+    tell.
+    """
+    return backend.watch_pointer()
+
+
+def undo_target(k):
+    """
+    Return the checkpoint that undoing `k` goes back to.
+
+    That is its predecessor, unless an undo recorded another target for it
+    (see `set_undo_target`).
+    """
+    found = backend.undo_predecessor(k)
+    return found if found is not None else predecessor(k)
+
+
+def set_undo_target(k, target):
+    backend.set_undo_predecessor(k, target)
+
+
 def incr_checkpoint():
     new = roll(get_checkpoint(), 1)
-    redis.set(checkpoint, new)
+    backend.set_pointer(new)
     return new
 
 
 def set_checkpoint(value):
     if value >= keep:
         raise ValueError(f"Invalid: {value} exceeds keep {keep}")
-    if not redis.get(f"db-save-{value}"):
+    if not backend.load_checkpoint(value):
         raise ValueError(f"Invalid: {value} is not persisted")
-    return redis.set(checkpoint, value)
+    return backend.set_pointer(value)
 
 
 def checkpoint_data():
     current = get_checkpoint()
-    listing = list(
-        redis.scan_iter(match="db-save-*")
-    )
     by_time = sorted(
-        listing,
-        key=lambda x: redis.get(f"ts:{x}") or -1,
+        backend.checkpoint_stamps(),
+        key=lambda x: x[1],
         reverse=True,
     )
+    hot = [k for (k, _) in by_time]
+    # Archived checkpoints are listed from the archive's index alone
+    cold = []
+    if archive is not None:
+        cold = [archive_base + i for (i, _) in archive.stamps()]
     return {
         "current": current,
-        "listing": [int(x.replace("db-save-", "")) for x in by_time],
+        "listing": hot + cold,
     }
 
 
@@ -70,49 +121,243 @@ def incrementing_checkpoint():
 
     else:
         print(f"Advancing to checkpoint {new}")
-        redis.set(checkpoint, new)
+        backend.set_pointer(new)
         return new
 
 
+def get_timestamp(k):
+    if is_archived(k):
+        return _archived(k, archive.timestamp)
+    return backend.checkpoint_timestamp(k)
+
+
+def checkpoint_at(ts):
+    """
+    Return the checkpoint that was current at time `ts`, from either tier, or
+    None if there was none yet.
+    """
+    k = backend.checkpoint_at(ts)
+    if k is not None:
+        return k
+    # Everything archived is older than everything in the hot tier
+    i = archive.at(ts) if archive is not None else None
+    return archive_base + i if i is not None else None
+
+
 def read(k=None):
-    k = k or get_checkpoint()
+    if k is None:
+        k = get_checkpoint()
     if k is None:
         return {}
 
-    return json.loads(redis.get(f"db-save-{k}") or "null")
+    return json.loads(read_encoded(k) or "null")
+
+
+def read_encoded(k):
+    """
+    Return checkpoint `k` as stored, i.e. JSON-encoded, or None.
+    """
+    if is_archived(k):
+        return _archived(k, archive.read_encoded)
+    return backend.load_checkpoint(k)
+
+
+def _archived(k, reader):
+    if archive is None:
+        return None
+    try:
+        return reader(k - archive_base)
+    except IndexError:
+        return None
+
+
+def archive_slot(k):
+    """
+    Move checkpoint `k` out of the hot tier into the archive, if there is
+    one, before its slot is reused.
+    """
+    if archive is None:
+        return None
+    encoded = backend.load_checkpoint(k)
+    if encoded is None:
+        return None
+    ts = get_timestamp(k)
+    i = archive.append(encoded.encode(), ts if ts is not None else 0.0)
+    print(f"Archived checkpoint {k} as {archive_base + i}")
+    return archive_base + i
+
+
+def write(data, changed=None, ts=None):
+    """
+    Commit `data` as a new checkpoint, written at `ts` (by default, now).
 
+    `changed` lists the paths modified since the previous checkpoint, and is
+    stored alongside the new checkpoint as its delta.
 
-def write(data):
+    Returns the new checkpoint, or None if the commit failed.
+    """
+    if ts is None:
+        ts = datetime.datetime.now().timestamp()
+    committed = None
     with incrementing_checkpoint() as (old, new):
-        current = read(old)
-        if current != data:
-            print(
-                f"Found change from data in checkpoint {old}:"
-                f"\nold={current}\n{data=}"
-            )
-            redis.set(f"db-save-{new}", json.dumps(data))
-            redis.set(f"ts:db-save-{new}", datetime.datetime.now().timestamp())
-        else:
-            msg = (
-                f"Skipping commit of checkpoint {new} as there is no change "
-                f"to the state.  Using checkpoint {old}."
-            )
-            print(msg)
-            raise ValueError(msg)
+        print(f"Committing checkpoint {new} (after {old}): changed {changed}")
+        archive_slot(new)
+        backend.save_checkpoint(
+            new,
+            json.dumps(data),
+            ts,
+            json.dumps(changed) if changed is not None else None,
+        )
+        committed = new
+    return committed
+
+
+def restore(k):
+    """
+    Commit a copy of checkpoint `k` as a new checkpoint.
+
+    The stored state is copied within storage (or from the archive), so it
+    is never decoded or re-encoded here.
+
+    Returns the new checkpoint.
+    """
+    if get_timestamp(k) is None:
+        raise ValueError(f"Invalid: {k} is not persisted")
+    committed = None
+    with tracing.span("database.write"):
+        with incrementing_checkpoint() as (old, new):
+            print(f"Restoring checkpoint {k} as {new} (after {old})")
+            archive_slot(new)
+            ts = datetime.datetime.now().timestamp()
+            if is_archived(k):
+                backend.save_checkpoint(new, read_encoded(k).decode(), ts)
+            elif not backend.copy_checkpoint(k, new, ts):
+                raise ValueError(f"Invalid: {k} is not persisted")
+            committed = new
+    if committed is None:
+        raise ValueError(f"Could not restore checkpoint {k}")
+
+    # The restored state is the same as `k`'s, so its snapshot can be shared.
+    # The live model is reloaded by the next edit.
+    snapshot = history.get(k)
+    if snapshot is None:
+        snapshot = freeze(read(k))
+    history.put(committed, snapshot)
+    previous = history.get(old)
+    if previous is None:
+        previous = freeze(read(old)) if old is not None else None
+    log_changes(committed, ts, previous, snapshot, {()})
+    live["checkpoint"] = None
+    live["envelope"] = None
+    return committed
+
+
+def reset():
+    """
+    Delete every checkpoint, in both tiers, along with the command queue.
+    """
+    backend.reset()
+    if archive is not None:
+        archive.clear()
+    live["checkpoint"] = None
+    live["envelope"] = None
+    history.snapshots.clear()
+
+
+def log_changes(k, ts, old, new, changed):
+    """
+    Append a record of each entity's changes in checkpoint `k`, between the
+    snapshots `old` and `new`, to that entity's history.
+    """
+    base = {"checkpoint": k, "ts": ts, "command": current_command.get()}
+    records = [
+        (name, json.dumps({**base, **change}))
+        for (name, change) in entity_changes(old, new, changed)
+    ]
+    if records:
+        backend.append_history(records)
+
+
+def entity_history(name):
+    """
+    Return the change records for entity `name`, oldest first.
+    """
+    return [json.loads(record) for record in backend.entity_history(name)]
+
+
+def read_delta(k):
+    """
+    Return the paths changed by checkpoint `k`, or None if not recorded.
+    """
+    if is_archived(k):
+        return None
+    delta = backend.checkpoint_delta(k)
+    if delta is None:
+        return None
+    return [tuple(path) for path in json.loads(delta)]
+
+
+# The worker is the only writer, so it keeps the latest checkpoint between
+# commands as a live `Game` model, instead of re-reading and re-decoding it for
+# every command.
+live = {"checkpoint": None, "envelope": None}
+
+# ... and the checkpoints it has committed, as structure-sharing snapshots.
+history = History(keep)
+
+# The name of the command being run, which its changes are recorded under
+current_command = ContextVar("current_command", default=None)
+
+
+def _live_envelope():
+    current = get_checkpoint()
+    if live["envelope"] is not None and live["checkpoint"] == current:
+        return (current, live["envelope"])
+    data = read(current)
+    if current is not None and current not in history:
+        # Kept as the state the next edit's changes are recorded against
+        history.record(current, data)
+    return (current, {"data": Game.from_json(data)})
 
 
 @contextmanager
 def editing():
-    game = read()
-    enveloped = {"data": game}
+    with tracing.span("database.load"):
+        (current, enveloped) = _live_envelope()
+    original = enveloped["data"]
+    # Until the edit is committed, the live copy may be half-modified
+    live["envelope"] = None
     try:
-        yield enveloped
+        with changes.recording() as changed:
+            yield enveloped
     except Exception as err:
+        # Nothing is committed, and the caller reports the error
         exc = _exception(err)
         print(
             f"Error editing state.  "
-            f"Encountered exception (next line):\n{exc}\n"
-            f"Saw data (next line):\n{enveloped})"
+            f"Encountered exception (next line):\n{exc}"
         )
+        raise
     else:
-        write(enveloped.get("data"))
+        if enveloped["data"] is not original:
+            # Replaced wholesale
+            changed = {()}
+        if not changed:
+            print(f"No change to the state.  Staying at checkpoint {current}.")
+            committed = current
+        else:
+            data = enveloped["data"].to_json()
+            changed = sorted(changed)
+            ts = datetime.datetime.now().timestamp()
+            with tracing.span("database.write"):
+                committed = write(data, changed, ts)
+            if committed is not None:
+                with tracing.span("database.history"):
+                    previous = history.get(current)
+                    snapshot = history.record(
+                        committed, data, changed, base=current
+                    )
+                    log_changes(committed, ts, previous, snapshot, changed)
+        if committed is not None:
+            live["checkpoint"] = committed
+            live["envelope"] = enveloped
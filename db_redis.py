@@ -1,15 +1,82 @@
 import os
 from redis import Redis
+from redis import BlockingConnectionPool
+from redis import UnixDomainSocketConnection
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.retry import Retry
+
+
+def _float_or_none(value):
+    return float(value) if value not in (None, "") else None
+
 
 redis_host = os.environ.get("REDIS_HOST", "localhost")
 redis_port = os.environ.get("REDIS_PORT", "6379")
+# If set, talk to a co-located redis over this unix domain socket instead of
+# TCP.  Takes precedence over REDIS_HOST/REDIS_PORT.
+redis_socket = os.environ.get("REDIS_SOCKET")
 
 redis_password = os.environ["REDIS_PASSWORD"]
 
-redis = Redis(
-    host=redis_host,
-    port=redis_port,
-    db=0,
-    password=redis_password,
-    decode_responses=True,
+# Pool and connection tuning
+max_connections = int(os.environ.get("REDIS_MAX_CONNECTIONS", "16"))
+blocking_max_connections = int(
+    os.environ.get("REDIS_BLOCKING_MAX_CONNECTIONS", "4")
+)
+pool_timeout = _float_or_none(os.environ.get("REDIS_POOL_TIMEOUT", "5"))
+socket_timeout = _float_or_none(os.environ.get("REDIS_SOCKET_TIMEOUT", "5"))
+connect_timeout = _float_or_none(os.environ.get("REDIS_CONNECT_TIMEOUT", "2"))
+health_check_interval = int(
+    os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", "30")
+)
+# Retries of commands that failed to reach redis.  Timeouts are never retried:
+# the command may have run anyway, and queueing or counting it twice is worse
+# than reporting the error.
+retries = int(os.environ.get("REDIS_RETRIES", "3"))
+
+
+def _connection_kwargs(timeout):
+    kwargs = {
+        "db": 0,
+        "password": redis_password,
+        "decode_responses": True,
+        "socket_timeout": timeout,
+        "health_check_interval": health_check_interval,
+        "retry_on_timeout": False,
+        # `Retry` would otherwise retry timeouts too
+        "retry": Retry(
+            ExponentialBackoff(),
+            retries,
+            supported_errors=(RedisConnectionError,),
+        ),
+    }
+    if redis_socket:
+        kwargs["connection_class"] = UnixDomainSocketConnection
+        kwargs["path"] = redis_socket
+    else:
+        kwargs["host"] = redis_host
+        kwargs["port"] = redis_port
+        kwargs["socket_connect_timeout"] = connect_timeout
+        kwargs["socket_keepalive"] = True
+    return kwargs
+
+
+def make_pool(size, timeout):
+    return BlockingConnectionPool(
+        max_connections=size,
+        timeout=pool_timeout,
+        **_connection_kwargs(timeout),
+    )
+
+
+# Normal commands: short socket timeouts so a wedged connection surfaces as an
+# error instead of hanging a request.
+redis = Redis(connection_pool=make_pool(max_connections, socket_timeout))
+
+# Blocking stream reads (`XREAD ... BLOCK 0`) wait indefinitely, so they get
+# their own pool without a socket timeout.  A reader parked on the stream can
+# then never hold a connection that normal commands are waiting for.
+redis_blocking = Redis(
+    connection_pool=make_pool(blocking_max_connections, None),
 )
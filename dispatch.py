@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+
+
+def _resolve(future, result):
+    # The waiter may have timed out, and cancelled it, meanwhile
+    if not future.done():
+        future.set_result(result)
+
+
+class ResultDispatcher:
+    """
+    Hands command results to whoever in this process is waiting for them, as
+    the worker stores them, so that waiting doesn't mean polling.
+
+    A background thread listens for notifications of stored results (see
+    `StorageBackend.watch_results`), and loads a result only when someone is
+    waiting for it.  Whenever the notifications aren't being received (the
+    connection dropped, or the backend has none), the thread polls for the
+    awaited results every `poll` seconds instead.
+    """
+
+    def __init__(self, load, watch, poll=0.05, retry=1.0):
+        # `load` returns the stored result for a key, or None
+        self.load = load
+        # `watch` returns None if there are no notifications
+        self.watch = watch
+        self.poll = poll
+        self.retry = retry
+        self.listening = False
+        # Key -> [(loop, future)] of everyone waiting for it
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._listen, daemon=True)
+            self.thread.start()
+
+    def _deliver(self, key):
+        with self.lock:
+            waiting = list(self.pending.get(key, ()))
+        if not waiting:
+            return
+        result = self.load(key)
+        if result is None:
+            return
+        for (loop, future) in waiting:
+            loop.call_soon_threadsafe(_resolve, future, result)
+
+    def _poll_pending(self):
+        with self.lock:
+            keys = list(self.pending)
+        for key in keys:
+            self._deliver(key)
+
+    def _poll_for(self, seconds=None):
+        end = None if seconds is None else time.monotonic() + seconds
+        while end is None or time.monotonic() < end:
+            self._poll_pending()
+            time.sleep(self.poll)
+
+    def _listen(self):
+        while True:
+            try:
+                events = self.watch()
+                if events is None:
+                    print("dispatch | no result notifications, polling")
+                    self._poll_for()
+                    return
+                for key in events:
+                    self.listening = True
+                    if key is None:
+                        # Subscribed: catch up on anything stored meanwhile
+                        self._poll_pending()
+                    else:
+                        self._deliver(key)
+            except Exception as err:
+                print(f"dispatch | notifications failed: {err!r}")
+            self.listening = False
+            self._poll_for(self.retry)
+
+    async def wait(self, key, timeout):
+        """
+        Return the result stored under `key`, once it is.
+
+        Raises `TimeoutError` if that takes more than `timeout` seconds.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self.lock:
+            self.pending.setdefault(key, []).append(waiter)
+        try:
+            # It may have been stored before anyone was waiting for it
+            found = await asyncio.to_thread(self.load, key)
+            if found is not None:
+                return found
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            with self.lock:
+                waiting = self.pending.get(key, [])
+                waiting.remove(waiter)
+                if not waiting:
+                    self.pending.pop(key, None)
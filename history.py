@@ -0,0 +1,314 @@
+from collections import OrderedDict
+
+from persistent import PMap
+from persistent import assoc_in
+from persistent import dissoc_in
+from persistent import freeze
+from persistent import thaw
+from utils import get_path
+
+
+# Not `utils.UNSET`, which `get_path` takes to mean "no default"
+_MISSING = object()
+
+
+def apply_changes(previous, data, changed):
+    """
+    Build the snapshot of `data` by patching the `changed` paths into the
+    `previous` snapshot, so that everything else is shared with it.
+    """
+    snapshot = previous
+    for path in changed:
+        value = get_path(data, list(path), default=_MISSING)
+        if value is not _MISSING:
+            snapshot = assoc_in(snapshot, path, freeze(value))
+        elif isinstance(snapshot, PMap) and path:
+            snapshot = dissoc_in(snapshot, path)
+    return snapshot
+
+
+class History:
+    """
+    The last `size` checkpoints, held as frozen, structure-sharing snapshots.
+
+    A checkpoint recorded with its delta against a predecessor that is also
+    held here shares every unchanged subtree with that predecessor, so the
+    whole ring costs roughly one state plus the deltas.
+
+    Entries can carry a `stamp` (the checkpoint's write timestamp) so that
+    readers which don't see every write can tell a reused ring slot apart.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.snapshots = OrderedDict()
+
+    def __contains__(self, k):
+        return k in self.snapshots
+
+    def get(self, k, stamp=None):
+        entry = self.snapshots.get(k)
+        if entry is None:
+            return None
+        (entry_stamp, snapshot) = entry
+        if stamp is not None and entry_stamp != stamp:
+            return None
+        return snapshot
+
+    def _predecessor(self, base, stamp, base_stamp):
+        entry = self.snapshots.get(base)
+        if entry is None:
+            return None
+        (entry_stamp, snapshot) = entry
+        if base_stamp is None:
+            return snapshot
+        # A snapshot held from an earlier use of the slot is out of date
+        if entry_stamp is not None and entry_stamp != base_stamp:
+            return None
+        # A predecessor written after `k` is a reused slot, not the state
+        # the delta was taken against
+        if stamp is not None and base_stamp >= stamp:
+            return None
+        return snapshot
+
+    def record(
+        self, k, data, changed=None, base=None, stamp=None, base_stamp=None
+    ):
+        """
+        Hold `data` as checkpoint `k`, built on the snapshot of `base` if it
+        is held and `changed` is given.
+
+        If `base_stamp` is given, it is the write timestamp `base` has now,
+        and the snapshot of `base` is only used if it was recorded with it,
+        and it is older than `stamp`.
+        """
+        previous = None
+        if changed is not None and base is not None:
+            previous = self._predecessor(base, stamp, base_stamp)
+        if previous is not None:
+            snapshot = apply_changes(previous, data, changed)
+        else:
+            snapshot = freeze(data)
+        return self.put(k, snapshot, stamp)
+
+    def put(self, k, snapshot, stamp=None):
+        """
+        Hold an existing `snapshot` as checkpoint `k`.
+        """
+        self.snapshots.pop(k, None)
+        self.snapshots[k] = (stamp, snapshot)
+        while len(self.snapshots) > self.size:
+            self.snapshots.popitem(last=False)
+        return snapshot
+
+
+#
+# Diffing
+#
+
+
+def path_key(path):
+    """
+    Sort key for paths, in the order `diff(..., ordered=True)` yields them.
+    """
+    # Map keys and list indices only meet when a value changed type
+    return tuple((isinstance(c, str), c) for c in path)
+
+
+def _keys(value, ordered):
+    if isinstance(value, PMap):
+        keys = value.keys()
+    else:
+        keys = range(len(value))
+    if ordered:
+        return sorted(keys, key=lambda k: (isinstance(k, str), k))
+    return keys
+
+
+def _leaves(value, path, ordered=False):
+    if isinstance(value, (PMap, tuple)):
+        for k in _keys(value, ordered):
+            yield from _leaves(value[k], path + (k,), ordered)
+    else:
+        yield (path, value)
+
+
+def diff(old, new, path=(), ordered=False):
+    """
+    Yield the leaf-level differences between two snapshots, in the same
+    format as `utils.flat_diff`.
+
+    Subtrees shared between the snapshots are skipped without being walked.
+    If `ordered`, the differences come in `path_key` order, which is stable
+    across processes, at the cost of sorting the keys of changed maps.
+    """
+    if old is new:
+        return
+
+    if isinstance(old, PMap) and isinstance(new, PMap):
+        if ordered:
+            keys = sorted(set(old.keys()) | set(new.keys()))
+        else:
+            keys = list(old.keys()) + [k for k in new.keys() if k not in old]
+        for k in keys:
+            if k not in new:
+                for (p, x) in _leaves(old[k], path + (k,), ordered):
+                    yield ("delete", p, x)
+            elif k not in old:
+                for (p, x) in _leaves(new[k], path + (k,), ordered):
+                    yield ("insert", p, x)
+            else:
+                yield from diff(old[k], new[k], path + (k,), ordered)
+
+    elif isinstance(old, tuple) and isinstance(new, tuple):
+        for i in range(max(len(old), len(new))):
+            if i >= len(new):
+                for (p, x) in _leaves(old[i], path + (i,), ordered):
+                    yield ("delete", p, x)
+            elif i >= len(old):
+                for (p, x) in _leaves(new[i], path + (i,), ordered):
+                    yield ("insert", p, x)
+            else:
+                yield from diff(old[i], new[i], path + (i,), ordered)
+
+    elif isinstance(old, (PMap, tuple)) or isinstance(new, (PMap, tuple)):
+        old_leaves = dict(_leaves(old, path))
+        new_leaves = dict(_leaves(new, path))
+        paths = list(old_leaves)
+        paths += [p for p in new_leaves if p not in old_leaves]
+        if ordered:
+            paths.sort(key=path_key)
+        for p in paths:
+            if p not in new_leaves:
+                yield ("delete", p, old_leaves[p])
+            elif p not in old_leaves:
+                yield ("insert", p, new_leaves[p])
+            elif new_leaves[p] != old_leaves[p]:
+                yield ("edit", p, old_leaves[p], new_leaves[p])
+
+    elif old != new:
+        yield ("edit", path, old, new)
+
+
+def _get_in(snapshot, path):
+    for k in path:
+        if isinstance(snapshot, PMap):
+            snapshot = snapshot.get(k, _MISSING)
+        elif isinstance(snapshot, tuple) and isinstance(k, int):
+            snapshot = snapshot[k] if 0 <= k < len(snapshot) else _MISSING
+        else:
+            return _MISSING
+        if snapshot is _MISSING:
+            return _MISSING
+    return snapshot
+
+
+def diff_at(old, new, path, ordered=False):
+    """
+    Like `diff`, but only for whatever is at `path` in each snapshot.
+    """
+    path = tuple(path)
+    old = _get_in(old, path)
+    new = _get_in(new, path)
+    if old is _MISSING and new is _MISSING:
+        return
+    elif old is _MISSING:
+        for (p, x) in _leaves(new, path, ordered):
+            yield ("insert", p, x)
+    elif new is _MISSING:
+        for (p, x) in _leaves(old, path, ordered):
+            yield ("delete", p, x)
+    else:
+        yield from diff(old, new, path, ordered)
+
+
+def resolve_path(parts, *snapshots):
+    """
+    Turn the string components of a path (e.g. from a URL) into the keys
+    and indices it has in `snapshots`.
+    """
+    path = []
+    nodes = list(snapshots)
+    for part in parts:
+        if part.isdigit() and any(isinstance(n, tuple) for n in nodes):
+            part = int(part)
+        path.append(part)
+        nodes = [_get_in(n, (part,)) for n in nodes]
+    return tuple(path)
+
+
+def diff_under(old, new, prefixes=()):
+    """
+    `diff(old, new, ordered=True)`, limited to the paths under any of
+    `prefixes` (everything, if there are none), still in `path_key` order.
+    """
+    if not prefixes:
+        yield from diff(old, new, ordered=True)
+        return
+    covered = None
+    for prefix in sorted(prefixes, key=path_key):
+        if covered is not None and prefix[:len(covered)] == covered:
+            continue
+        covered = prefix
+        yield from diff_at(old, new, prefix, ordered=True)
+
+
+#
+# Per-entity change records
+#
+
+
+def _change(path, before, after):
+    change = {"path": list(path)}
+    if before is not _MISSING:
+        change["old"] = thaw(before)
+    if after is not _MISSING:
+        change["new"] = thaw(after)
+    return change
+
+
+def entity_changes(old, new, changed):
+    """
+    Yield (entity, change) for the `changed` paths under "entities", from
+    the snapshots before and after them.
+
+    Each change holds the path within the entity, and the plain JSON values
+    there before ("old") and after ("new"), each left out where absent.
+    Changes recorded at a single path are reported at that path, however
+    large the values; changes to all the entities at once (e.g. a replaced
+    state) are broken down into their leaves.
+    """
+    covered = None
+    for path in sorted(changed, key=path_key):
+        if covered is not None and path[:len(covered)] == covered:
+            continue
+        covered = path
+        if len(path) >= 2 and path[0] == "entities":
+            before = _get_in(old, path)
+            after = _get_in(new, path)
+            if before != after:
+                yield (path[1], _change(path[2:], before, after))
+        elif path == ("entities",)[:len(path)]:
+            yield from _all_entity_changes(old, new)
+
+
+def _all_entity_changes(old, new):
+    names = set()
+    for snapshot in (old, new):
+        entities = _get_in(snapshot, ("entities",))
+        if isinstance(entities, PMap):
+            names.update(entities.keys())
+    for name in sorted(names):
+        path = ("entities", name)
+        before = _get_in(old, path)
+        after = _get_in(new, path)
+        if before is _MISSING or after is _MISSING:
+            # Added or removed as a whole
+            yield (name, _change((), before, after))
+            continue
+        for (op, p, *values) in diff(before, after, path, ordered=True):
+            if op == "insert":
+                values = [_MISSING, *values]
+            elif op == "delete":
+                values = [*values, _MISSING]
+            yield (name, _change(p[2:], *values))
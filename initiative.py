@@ -0,0 +1,224 @@
+import random
+
+from tracking import changes
+
+
+class Initiative:
+    """
+    The turn order.
+
+    Everyone in the turn order is in `entities`, with their initiative bonus
+    in `bonuses`.  Once the order has started, each of them is either in the
+    active order or in `deferred`.
+
+    The active order is a ring, held as `prev`/`nxt` links keyed by entity
+    name, and `current` is the name of the entity whose turn it is.  So
+    advancing, deferring, undeferring and dropping are all constant time, and
+    `current` keeps pointing at the same entity when others are removed.  The
+    stored JSON shape (a list plus a `current` index) is only produced by
+    `to_json`.
+
+    The operations below report themselves to `tracking.changes`, under the
+    game's `order` key.
+    """
+
+    __slots__ = (
+        "entities",
+        "bonuses",
+        "deferred",
+        "prev",
+        "nxt",
+        "head",
+        "current",
+        "started",
+    )
+
+    def __init__(self):
+        # Dicts with None values stand in for insertion-ordered sets
+        self.entities = {}
+        self.bonuses = {}
+        self.deferred = {}
+        self.prev = {}
+        self.nxt = {}
+        self.head = None
+        self.current = None
+        self.started = False
+
+    @classmethod
+    def from_json(cls, data):
+        order = cls()
+        order.entities = dict.fromkeys(data.get("entities", []))
+        order.bonuses = dict(data.get("bonuses", {}))
+        order.deferred = dict.fromkeys(data.get("deferred", []))
+        active = data.get("order", [])
+        for name in active:
+            if name not in order.nxt:
+                order._append(name)
+        current = data.get("current")
+        order.started = current is not None
+        if current is not None and active:
+            order.current = active[current % len(active)]
+        return order
+
+    def to_json(self):
+        active = self.active()
+        if self.current is not None:
+            current = active.index(self.current)
+        else:
+            current = 0 if self.started else None
+        return {
+            "entities": list(self.entities),
+            "bonuses": dict(self.bonuses),
+            "order": active,
+            "current": current,
+            "deferred": list(self.deferred),
+        }
+
+    def __eq__(self, other):
+        # So that replacing an order with an equal one isn't a change
+        if not isinstance(other, Initiative):
+            return NotImplemented
+        return self.to_json() == other.to_json()
+
+    def __len__(self):
+        return len(self.nxt)
+
+    def __contains__(self, name):
+        return name in self.nxt
+
+    def active(self):
+        result = []
+        name = self.head
+        for _ in range(len(self.nxt)):
+            result.append(name)
+            name = self.nxt[name]
+        return result
+
+    #
+    # Ring maintenance
+    #
+
+    def _append(self, name):
+        if self.head is None:
+            self.head = name
+            self.prev[name] = name
+            self.nxt[name] = name
+        else:
+            self._insert_before(self.head, name)
+            # Appending at the end of a ring is inserting before the head,
+            # without the new entry becoming the head
+            self.head = self.nxt[name]
+
+    def _insert_before(self, anchor, name):
+        before = self.prev[anchor]
+        self.prev[name] = before
+        self.nxt[name] = anchor
+        self.nxt[before] = name
+        self.prev[anchor] = name
+        if self.head == anchor:
+            self.head = name
+
+    def _unlink(self, name):
+        before = self.prev.pop(name)
+        after = self.nxt.pop(name)
+        if not self.nxt:
+            self.head = None
+            self.current = None
+            return
+        self.nxt[before] = after
+        self.prev[after] = before
+        if self.head == name:
+            self.head = after
+        if self.current == name:
+            self.current = after
+
+    #
+    # Operations
+    #
+
+    def touch(self):
+        changes.mark(("order",))
+
+    def is_running(self):
+        return self.current is not None
+
+    def add(self, name, bonus):
+        self.touch()
+        self.entities[name] = None
+        self.bonuses[name] = bonus
+        if name not in self.nxt:
+            self.deferred[name] = None
+
+    def start(self):
+        self.touch()
+        ordered = sorted(
+            self.entities,
+            key=lambda x: (self.bonuses.get(x, 0), random.random()),
+            reverse=True,
+        )
+        self.prev = {}
+        self.nxt = {}
+        self.head = None
+        for name in ordered:
+            self._append(name)
+        self.deferred = {}
+        self.current = self.head
+        self.started = True
+
+    def advance(self):
+        if self.is_running():
+            self._move_to(self.nxt[self.current])
+        else:
+            self.start()
+
+    def retreat(self):
+        if self.is_running():
+            self._move_to(self.prev[self.current])
+        else:
+            self.start()
+
+    def _move_to(self, name):
+        if name != self.current:
+            self.touch()
+        self.current = name
+
+    def drop(self, name=None):
+        """
+        Take `name` (default: whoever's turn it is) out of the turn order.
+        """
+        if name is None:
+            name = self.current
+        if name is None:
+            return
+        if name not in self.entities and name not in self.deferred:
+            if name not in self:
+                return
+        self.touch()
+        self.entities.pop(name, None)
+        self.deferred.pop(name, None)
+        if name in self.nxt:
+            self._unlink(name)
+
+    def defer(self):
+        active = self.current
+        if active is None:
+            return
+        self.touch()
+        self._unlink(active)
+        self.deferred[active] = None
+
+    def undefer(self, name):
+        if not self.is_running():
+            return
+        self.touch()
+        self.deferred.pop(name)
+        self._insert_before(self.current, name)
+        self.current = name
+
+    def remove(self, name):
+        """
+        Forget `name` entirely, e.g. because the entity was deleted.
+        """
+        self.drop(name)
+        if self.bonuses.pop(name, None) is not None:
+            self.touch()
@@ -0,0 +1,85 @@
+#
+# Priority lanes for commands
+#
+# Commands are queued in one of two lanes by name: quick interactive commands
+# (advancing the turn order, checking stress boxes...) and heavy bulk ones
+# (overwriting or restoring the whole state, clearing everyone's stress...).
+# The worker runs interactive commands first, so they don't wait behind bulk
+# work, but lets a bulk command through after `burst` interactive ones in a
+# row, so bulk work isn't starved either.
+#
+
+import asyncio
+from collections import deque
+import os
+
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+# Highest priority first
+LANES = (INTERACTIVE, BULK)
+
+# Interactive commands run in a row while bulk ones are waiting
+burst = int(os.environ.get("WORKER_INTERACTIVE_BURST", "8"))
+
+
+class Scheduler:
+    """
+    Queues of pending commands, one per lane, taken in priority order.
+    """
+
+    def __init__(self, burst=burst):
+        self.burst = burst
+        self.queues = {lane: deque() for lane in LANES}
+        self.streak = 0
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def put(self, lane, item):
+        self.queues[lane].append(item)
+        self.ready.set()
+
+    def _choose(self):
+        # The lane to take from next, and the streak after taking from it
+        waiting = [lane for lane in LANES if self.queues[lane]]
+        (first, *rest) = waiting
+        overtaking = rest and first == LANES[0]
+        if overtaking and self.streak >= self.burst:
+            # Let a lower lane through, once
+            return (rest[0], 0)
+        # Only count the interactive commands that overtook something
+        return (first, self.streak + 1 if overtaking else 0)
+
+    async def get(self):
+        while not len(self):
+            self.ready.clear()
+            await self.ready.wait()
+        (lane, self.streak) = self._choose()
+        return self.queues[lane].popleft()
+
+    def take_if(self, predicate):
+        """
+        Take the item `get` would return next, if there is one and
+        `predicate` holds for it, or return None.
+        """
+        if not len(self):
+            return None
+        (lane, streak) = self._choose()
+        if not predicate(self.queues[lane][0]):
+            return None
+        self.streak = streak
+        return self.queues[lane].popleft()
+
+    async def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for something to be queued.
+        """
+        if len(self):
+            return
+        self.ready.clear()
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
@@ -1,19 +1,61 @@
+import asyncio
+from dataclasses import asdict
+from dataclasses import fields
 import json
+import os
 from functools import wraps
-import random
+import time
 
 from command_stream import wait_for_commands
 from command_stream import read_command_log
+from command_stream import result_key
+from command_stream import start_consuming
 from command_stream import store_result
 from contextlib import contextmanager
 import database
 from utils import get_path
-from utils import drop_if
-from utils import Predicates
+from models import Aspect
+from models import Entity
+from models import Game
+from models import InvalidState
+from models import StressTrack
+from initiative import Initiative
+from lanes import BULK
+from lanes import INTERACTIVE
+from lanes import Scheduler
+import tracing
 from errors import _ok
 from errors import _error
 from errors import _exception
 from errors import _fail
+from schemas import SchemaError
+from schemas import compile_schema
+from schemas import decode
+from schemas import encode
+from schemas import NoArgs
+from schemas import EntityArgs
+from schemas import CreateEntity
+from schemas import EditEntity
+from schemas import SetEntity
+from schemas import SetPortrait
+from schemas import AdjustFp
+from schemas import SetFp
+from schemas import AddAspect
+from schemas import NamedAspect
+from schemas import ClearAllConsequences
+from schemas import ClearConsequences
+from schemas import StressBox
+from schemas import AbsorbStress
+from schemas import OrderAdd
+from schemas import OptionalEntity
+from schemas import OverwriteState
+from schemas import RestoreCheckpoint
+from schemas import Test
+from schemas import BulkEntities
+from schemas import BulkSetFp
+from schemas import BulkAddAspect
+from schemas import BulkStressBox
+from schemas import BulkAbsorbStress
 
 
 #
@@ -25,12 +67,17 @@ class CommandRegistrar:
 
     def __init__(self):
         self.commands = {}
+        self.schemas = {}
+        self.lanes = {}
 
-    def register(self, *names):
+    def register(self, *names, schema=NoArgs, lane=INTERACTIVE):
+        compile_schema(schema)
 
         def _register(func):
             for name in names:
                 self.commands[name] = func
+                self.schemas[name] = schema
+                self.lanes[name] = lane
 
             @wraps(func)
             def _a(*args, **kwargs):
@@ -43,10 +90,54 @@ class CommandRegistrar:
     def get(self, cmd):
         return self.commands.get(cmd)
 
+    def lane(self, data):
+        """
+        The priority lane the raw command `data` should be queued in.
+        """
+        name = data.get("command") if isinstance(data, dict) else None
+        return self.lanes.get(name, INTERACTIVE)
+
+    def mutates(self, data):
+        """
+        Whether the raw command `data` may modify the state.
+
+        Unrecognized commands count as mutating, so that their errors are
+        reported in order with everything else.
+        """
+        name = data.get("command") if isinstance(data, dict) else None
+        func = self.commands.get(name)
+        return func is None or getattr(func, "mutates", False)
+
+    def decode(self, data):
+        """
+        Validate a raw command dict, returning its name and typed arguments.
+
+        Raises `SchemaError` if the command is unknown or malformed.
+        """
+        name = data.get("command") if isinstance(data, dict) else None
+        schema = self.schemas.get(name)
+        if schema is None:
+            raise SchemaError(f"Unrecognized command: {name!r}")
+        args = {k: v for (k, v) in data.items() if k != "command"}
+        return (name, decode(schema, args))
+
+    def normalize(self, data):
+        (name, typed) = self.decode(data)
+        return encode(name, typed)
+
 
 cmds = CommandRegistrar()
 
 
+def serialized(func):
+    """
+    Mark a command as modifying the state, so that the worker runs it one at
+    a time, in order with the other such commands.
+    """
+    func.mutates = True
+    return func
+
+
 def implicit_edit(func):
 
     @wraps(func)
@@ -54,24 +145,100 @@ def implicit_edit(func):
         with database.editing() as game:
             return func(game, *args, **kwargs)
 
-    return _implicit
+    return serialized(_implicit)
 
 
-def process_command(cmd, entry_id=None):
-    func = cmds.get(cmd.get("command"))
+def coalescing(func):
+    """
+    Mark an `implicit_edit` of a single entity as safe to run along with
+    others of the same command on the same entity, in one edit (see
+    `run_coalesced`).
+    """
+    if not hasattr(func, "__wrapped__"):
+        raise TypeError(f"Only an implicit_edit can coalesce: {func}")
+    func.coalesces = True
+    return func
 
-    if func:
-        try:
-            result = func(cmd)
 
-        except Exception as err:
-            result = _exception(err)
+def run_command(cmd, trace=None):
+    if trace is not None:
+        # Since it was read from the stream
+        trace.add("worker.queue", trace.end)
+    try:
+        (name, typed) = cmds.decode(cmd)
+    except SchemaError as err:
+        return _error(cmd, str(err))
+    # Changes are recorded in entities' histories under the command's name
+    token = database.current_command.set(name)
+    traced = tracing.current.set(trace)
+    try:
+        with tracing.span("worker.handler"):
+            return cmds.get(name)(typed)
+    except Exception as err:
+        return _exception(err)
+    finally:
+        tracing.current.reset(traced)
+        database.current_command.reset(token)
+
+
+def coalescing_key(cmd):
+    """
+    Return what `cmd` may be coalesced with (see `run_coalesced`): its name
+    and entity, or None if it isn't marked as `coalescing`.
+    """
+    name = cmd.get("command")
+    if not getattr(cmds.commands.get(name), "coalesces", False):
+        return None
+    return (name, cmd.get("entity", cmd.get("name")))
+
+
+def run_coalesced(commands, traces=None):
+    """
+    Run commands with the same `coalescing_key` as a single edit, committed
+    as one checkpoint, and return each one's result.
+
+    If any of them fails outright, nothing is committed, and they are run
+    one at a time instead, to succeed or fail as they would have alone.
+    Each of their `traces` gets the spans of the shared edit.
+    """
+    traces = traces or [None] * len(commands)
+
+    def one_at_a_time():
+        return [run_command(c, t) for (c, t) in zip(commands, traces)]
+
+    try:
+        decoded = [cmds.decode(cmd) for cmd in commands]
+    except SchemaError:
+        return one_at_a_time()
+    results = []
+    started = time.time()
+    shared = tracing.Trace()
+    token = database.current_command.set(decoded[0][0])
+    traced = tracing.current.set(shared)
+    try:
+        with shared.span("worker.handler", coalesced=len(commands)):
+            with database.editing() as game:
+                for (name, typed) in decoded:
+                    results.append(cmds.get(name).__wrapped__(game, typed))
+    except Exception:
+        # `editing` dropped the edit
+        return one_at_a_time()
+    finally:
+        tracing.current.reset(traced)
+        database.current_command.reset(token)
+    for trace in traces:
+        if trace is not None:
+            trace.add("worker.queue", trace.end, started)
+            trace.spans.extend(shared.spans)
+    return results
 
-    else:
-        result = _error(cmd, "Unrecognized command")
+
+def process_command(cmd, entry_id=None):
+    trace = tracing.received(cmd)
+    result = run_command(cmd, trace)
 
     if entry_id is not None:
-        store_result(result, entry_id)
+        store_result(tracing.attach(result, trace), entry_id)
 
     return result
 
@@ -81,66 +248,67 @@ def process_command(cmd, entry_id=None):
 #
 
 
-@cmds.register("create_entity")
+def _entity(g, name):
+    return get_path(g.entities, [name])
+
+
+@cmds.register("create_entity", schema=CreateEntity)
 @implicit_edit
 def _create_entity(game, cmd):
     g = game["data"]
-    name = cmd["name"]
-    maxes = cmd.get("stress_maxes") or {}
-    refresh = int(cmd.get("refresh") or 0)
-    fate = int(cmd.get("fate") or 0)
-    is_pc = cmd.get("is_pc", False)
-    if "entities" not in g:
-        g["entities"] = {}
-    entities = get_path(g, ["entities"])
+    name = cmd.name
+    maxes = cmd.stress_maxes
+    refresh = cmd.refresh
+    fate = cmd.fate
+    is_pc = cmd.is_pc
+    entities = g.entities
     if name in entities:
         return _error(
             list(entities.keys()),
             f"Entity {name} already exists!",
         )
-    entities[name] = {
-        "name": name,
-        "fate": fate,
-        "refresh": refresh,
-        "aspects": [],
-        "stress": {
-            k: {"checked": [], "max": int(m)}
+    entities[name] = Entity(
+        name,
+        fate=fate,
+        refresh=refresh,
+        stress={
+            k: StressTrack(m)
             for (k, m) in maxes.items()
-            if int(m) > 0
+            if m > 0
         },
-        "is_pc": is_pc,
-    }
-    return _ok(entities[name])
+        is_pc=is_pc,
+    )
+    return _ok(entities[name].to_json())
 
 
-@cmds.register("edit_entity")
+@cmds.register("edit_entity", schema=EditEntity)
+@coalescing
 @implicit_edit
 def _edit_entity(game, cmd):
     g = game["data"]
-    name = cmd["name"]
-    maxes = cmd.get("stress_maxes")
-    refresh = cmd.get("refresh")
-    fate = cmd.get("fate")
-    is_pc = cmd.get("is_pc")
-    if "entities" not in g:
-        g["entities"] = {}
-    entities = get_path(g, ["entities"])
+    name = cmd.name
+    maxes = cmd.stress_maxes
+    refresh = cmd.refresh
+    fate = cmd.fate
+    is_pc = cmd.is_pc
+    entities = g.entities
     if name not in entities:
         return _error(
             list(entities.keys()),
             f"Entity {name} does not exist!",
         )
+    e = entities[name]
 
     if refresh is not None:
-        entities[name]["refresh"] = int(refresh)
+        e.refresh = refresh
 
     if fate is not None:
-        entities[name]["fate"] = int(fate)
+        e.fate = fate
 
     if is_pc is not None:
-        entities[name]["is_pc"] = True if is_pc else False
+        e.is_pc = is_pc
 
-    e_stress = entities[name]["stress"]
+    e_stress = e.stress
     for (stress_type, max_stress) in maxes.items():
         if max_stress is None:
             continue
@@ -148,34 +316,33 @@ def _edit_entity(game, cmd):
             if max_stress == 0:
                 e_stress.pop(stress_type)
             else:
-                e_stress[stress_type]["max"] = int(max_stress)
+                e_stress[stress_type].resize(max_stress)
         else:
-            e_stress[stress_type] = {"checked": [], "max": int(max_stress)}
+            e_stress[stress_type] = StressTrack(max_stress)
 
-    return _ok(entities[name])
+    return _ok(e.to_json())
 
 
-@cmds.register("set_entity")
+@cmds.register("set_entity", schema=SetEntity, lane=BULK)
 @implicit_edit
 def _set_entity(game, cmd):
     g = game["data"]
-    name = cmd["name"]
-    entity_value = cmd["entity_value"]
-    if "entities" not in g:
-        g["entities"] = {}
-    entities = get_path(g, ["entities"])
-    entities[name] = entity_value
-    return _ok(entities[name])
+    name = cmd.name
+    entity_value = cmd.entity_value
+    entities = g.entities
+    try:
+        entities[name] = Entity.from_json(entity_value)
+    except InvalidState as err:
+        return _error(entity_value, str(err))
+    return _ok(entities[name].to_json())
 
 
-@cmds.register("remove_entity")
+@cmds.register("remove_entity", schema=EntityArgs)
 @implicit_edit
 def _remove_entity(game, cmd):
     g = game["data"]
-    name = cmd["entity"]
-    if "entities" not in g:
-        g["entities"] = {}
-    entities = get_path(g, ["entities"])
+    name = cmd.entity
+    entities = g.entities
     if name not in entities:
         return _error(
             list(entities.keys()),
@@ -185,172 +352,145 @@ def _remove_entity(game, cmd):
         entities.pop(name)
         # Remove from the turn order if it's in there
         _ensure_order(g)
-        g["order"]["deferred"] = drop_if(
-            Predicates.equal(name),
-            g["order"]["deferred"],
-        )
-        g["order"]["order"] = drop_if(
-            Predicates.equal(name),
-            g["order"]["order"],
-        )
-        g["order"]["entities"] = drop_if(
-            Predicates.equal(name),
-            g["order"]["entities"],
-        )
-        if name in g["order"]["bonuses"]:
-            g["order"]["bonuses"].pop(name)
-        return _ok(entities)
+        g.order.remove(name)
+        return _ok(g.entities_json())
 
 
-@cmds.register("set_portrait")
+@cmds.register("set_portrait", schema=SetPortrait)
+@coalescing
 @implicit_edit
 def _set_portrait(game, cmd):
     g = game["data"]
-    name = cmd["entity"]
-    portrait_url = cmd.get("portrait_url", "")
-    entities = get_path(g, ["entities"])
+    name = cmd.entity
+    portrait_url = cmd.portrait_url
+    entities = g.entities
     if name not in entities:
         return _error(
             list(entities.keys()),
             f"Entity {name} not present!",
         )
-    e = get_path(g, ["entities", name])
-    e["portrait"] = portrait_url
-    return _ok(e)
+    e = entities[name]
+    e.portrait = portrait_url
+    return _ok(e.to_json())
 
 
-@cmds.register("decrement_fp")
+@cmds.register("decrement_fp", schema=AdjustFp)
+@coalescing
 @implicit_edit
 def _decrement_fp(game, cmd):
     g = game["data"]
-    entity = cmd["entity"]
-    amount = int(cmd.get("amount") or 1)
-    e = get_path(g, ["entities", entity])
-    fp = e["fate"]
+    entity = cmd.entity
+    amount = cmd.amount or 1
+    e = _entity(g, entity)
+    fp = e.fate
     if fp >= amount:
-        e["fate"] -= amount
-        return _ok(e)
+        e.fate -= amount
+        return _ok(e.to_json())
     else:
         return _error(
-            e,
+            e.to_json(),
             f"Only {fp} FP: not enough FP to decrement by {amount}",
         )
 
 
-@cmds.register("increment_fp")
+@cmds.register("increment_fp", schema=AdjustFp)
+@coalescing
 @implicit_edit
 def _increment_fp(game, cmd):
     g = game["data"]
-    entity = cmd["entity"]
-    amount = int(cmd.get("amount") or 1)
-    e = get_path(g, ["entities", entity])
-    e["fate"] += amount
-    return _ok(e)
+    entity = cmd.entity
+    amount = cmd.amount or 1
+    e = _entity(g, entity)
+    e.fate += amount
+    return _ok(e.to_json())
 
 
-@cmds.register("set_fp")
+@cmds.register("set_fp", schema=SetFp)
+@coalescing
 @implicit_edit
 def _set_fp(game, cmd):
     g = game["data"]
-    entity = cmd["entity"]
-    fp = cmd["fp"]
-    e = get_path(g, ["entities", entity])
-    e["fate"] = fp
-    return _ok(e)
+    entity = cmd.entity
+    fp = cmd.fp
+    e = _entity(g, entity)
+    e.fate = fp
+    return _ok(e.to_json())
 
 
-@cmds.register("refresh_fp")
+@cmds.register("refresh_fp", schema=EntityArgs)
+@coalescing
 @implicit_edit
 def _refresh_fp(game, cmd):
     g = game["data"]
-    entity = cmd["entity"]
-    e = get_path(g, ["entities", entity])
-    refresh = e["refresh"]
-    fp = e["fate"]
-    new = max(fp, refresh)
-    e["fate"] = new
-    return _ok(e)
+    entity = cmd.entity
+    e = _entity(g, entity)
+    e.fate = max(e.fate, e.refresh)
+    return _ok(e.to_json())
 
 
-@cmds.register("add_aspect")
+@cmds.register("add_aspect", schema=AddAspect)
+@coalescing
 @implicit_edit
 def _add_aspect(game, cmd):
     g = game["data"]
-    entity = cmd["entity"]
-    aspect = {}
-    aspect["name"] = cmd["name"]
-    if "kind" in cmd:
-        aspect["kind"] = cmd["kind"]
-    if "tags" in cmd:
-        aspect["tags"] = cmd["tags"]
-    e = get_path(g, ["entities", entity])
-    existing = [a["name"].lower() for a in e["aspects"]]
-    if aspect["name"].lower() in existing:
+    entity = cmd.entity
+    aspect = Aspect(cmd.name, kind=cmd.kind, tags=cmd.tags)
+    e = _entity(g, entity)
+    if e.aspects.get(aspect.name):
         return _error(
-            existing,
-            f"Aspect {aspect} already present on {entity}",
+            [a.name for a in e.aspects],
+            f"Aspect {aspect.to_json()} already present on {entity}",
         )
     else:
-        e["aspects"].append(aspect)
-        return _ok(e)
+        e.aspects.add(aspect)
+        return _ok(e.to_json())
 
 
-@cmds.register("remove_aspect")
+@cmds.register("remove_aspect", schema=NamedAspect)
+@coalescing
 @implicit_edit
 def _remove_aspect(game, cmd):
     g = game["data"]
-    entity = cmd["entity"]
-    aspect_name = cmd["name"]
-    e = get_path(g, ["entities", entity])
-    current_names = [a["name"].lower() for a in e.get("aspects", [])]
-    if aspect_name.lower() in current_names:
-        e["aspects"] = [
-            a for a in e.get("aspects", [])
-            if a["name"].lower() != aspect_name.lower()
-        ]
-        return _ok(e)
+    entity = cmd.entity
+    aspect_name = cmd.name
+    e = _entity(g, entity)
+    found = e.aspects.get(aspect_name)
+    if found:
+        e.aspects.remove(found)
+        return _ok(e.to_json())
     else:
         return _error(
-            e["aspects"],
+            e.aspects.to_json(),
             f"No aspect '{aspect_name}' present on '{entity}'",
         )
 
 
-@cmds.register("tag_aspect")
+@cmds.register("tag_aspect", schema=NamedAspect)
+@coalescing
 @implicit_edit
 def _tag_aspect(game, cmd):
     g = game["data"]
-    entity = cmd["entity"]
-    aspect_name = cmd["name"]
-    e = get_path(g, ["entities", entity])
-    current_names = [a["name"].lower() for a in e.get("aspects", [])]
-    possible_matches = [
-        a for a in e.get("aspects", [])
-        if aspect_name.lower() in a["name"].lower()
-    ]
-    possible_names = [a["name"] for a in possible_matches]
+    entity = cmd.entity
+    aspect_name = cmd.name
+    e = _entity(g, entity)
+    possible_matches = e.aspects.matching(aspect_name)
+    possible_names = [a.name for a in possible_matches]
 
     if len(possible_matches) == 0:
         return _error(
-            e["aspects"],
+            e.aspects.to_json(),
             f"No aspect '{aspect_name}' present on '{entity}'",
         )
 
     elif len(possible_matches) == 1:
         aspect = possible_matches[0]
 
-    elif aspect := next(
-        (
-            a for a in possible_matches
-            if a["name"].lower() == aspect_name.lower()
-        ),
-        None,
-    ):
-        pass
+    elif exact := e.aspects.get(aspect_name):
+        aspect = exact[0]
 
     else:
         return _error(
-            e["aspects"],
+            e.aspects.to_json(),
             (
                 f"Ambiguous: '{aspect_name}' could refer to any of the "
                 f"following aspects on '{entity}': "
@@ -359,23 +499,20 @@ def _tag_aspect(game, cmd):
         )
 
     # Process the aspect if found
-    if aspect.get("kind") == "fragile":
-        e["aspects"] = [
-            a for a in e.get("aspects", [])
-            if a["name"].lower() != aspect_name.lower()
-        ]
-        return _ok(e)
-    elif aspect["tags"] > 0:
-        aspect["tags"] -= 1
-        return _ok(e)
+    if aspect.kind == "fragile":
+        e.aspects.remove([aspect])
+        return _ok(e.to_json())
+    elif (aspect.tags or 0) > 0:
+        aspect.tags -= 1
+        return _ok(e.to_json())
     else:
         return _error(
-            e["aspects"],
+            e.aspects.to_json(),
             f"Aspect '{aspect_name}' on '{entity}' has no free tags",
         )
 
 
-@cmds.register("remove_all_temporary_aspects")
+@cmds.register("remove_all_temporary_aspects", lane=BULK)
 @implicit_edit
 def _remove_all_temp_aspects(game, cmd):
     g = game["data"]
@@ -386,18 +523,16 @@ def _remove_all_temp_aspects(game, cmd):
         "extreme",
         "sticky",
     ]
-    if "entities" not in g:
-        g["entities"] = {}
-    for entity_name in g.get("entities", []):
-        entity = get_path(g, ["entities", entity_name])
-        entity["aspects"] = [
-            a for a in entity.get("aspects", [])
-            if a.get("kind") in long_aspects
-        ]
-    return _ok(g["entities"])
-
-
-@cmds.register("clear_all_consequences")
+    for entity in g.entities.values():
+        entity.aspects.keep_kinds(long_aspects)
+    return _ok(g.entities_json())
+
+
+@cmds.register(
+    "clear_all_consequences",
+    schema=ClearAllConsequences,
+    lane=BULK,
+)
 @implicit_edit
 def _clear_consequences(game, cmd):
     g = game["data"]
@@ -407,7 +542,7 @@ def _clear_consequences(game, cmd):
         "severe",
         "extreme",
     ]
-    sev = cmd["max_severity"]
+    sev = cmd.max_severity
 
     try:
         last_sev_idx = severities.index(sev)
@@ -420,20 +555,14 @@ def _clear_consequences(game, cmd):
     aspects_to_keep = severities[last_sev_idx+1:]
     print(f"{sev=} {last_sev_idx=} {aspects_to_keep=}")
 
-    if "entities" not in g:
-        g["entities"] = {}
+    for entity in g.entities.values():
+        entity.aspects.keep_kinds(aspects_to_keep)
 
-    for entity_name in g.get("entities", []):
-        entity = get_path(g, ["entities", entity_name])
-        entity["aspects"] = [
-            a for a in entity.get("aspects", [])
-            if a.get("kind") in aspects_to_keep
-        ]
+    return _ok(g.entities_json())
 
-    return _ok(g["entities"])
 
-
-@cmds.register("clear_consequences")
+@cmds.register("clear_consequences", schema=ClearConsequences)
+@coalescing
 @implicit_edit
 def _clear_consequences(game, cmd):
     g = game["data"]
@@ -443,9 +572,9 @@ def _clear_consequences(game, cmd):
         "severe",
         "extreme",
     ]
-    sev = cmd["max_severity"]
-    entity = cmd["entity"]
-    e = get_path(g, ["entities", entity])
+    sev = cmd.max_severity
+    entity = cmd.entity
+    e = _entity(g, entity)
 
     try:
         last_sev_idx = severities.index(sev)
@@ -458,113 +587,121 @@ def _clear_consequences(game, cmd):
     aspects_to_keep = severities[last_sev_idx+1:]
     print(f"{sev=} {last_sev_idx=} {aspects_to_keep=}")
 
-    if "entities" not in g:
-        g["entities"] = {}
-
-    e["aspects"] = [
-        a for a in e.get("aspects", [])
-        if a.get("kind") in aspects_to_keep
-    ]
+    e.aspects.keep_kinds(aspects_to_keep)
 
-    return _ok(e)
+    return _ok(e.to_json())
 
 
-@cmds.register("add_stress")
+@cmds.register("add_stress", schema=StressBox)
+@coalescing
 @implicit_edit
 def _add_stress(game, cmd):
     g = game["data"]
-    stress_kind = cmd["stress"]
-    box = int(cmd["box"])
-    entity = cmd["entity"]
-    e = get_path(g, ["entities", entity])
-    s = get_path(e, ["stress", stress_kind], default=None)
+    stress_kind = cmd.stress
+    box = cmd.box
+    entity = cmd.entity
+    e = _entity(g, entity)
+    s = e.stress.get(stress_kind)
     if s is None:
-        return _error(e, f"Entity {entity} has no {stress_kind} stress track")
-    if box > s["max"]:
         return _error(
-            e,
+            e.to_json(),
+            f"Entity {entity} has no {stress_kind} stress track",
+        )
+    if box > s.max:
+        return _error(
+            e.to_json(),
             (
                 f"Entity {entity} cannot take {box} {stress_kind} "
                 f"stress without consequence!"
             ),
         )
-    if box in s["checked"]:
+    if box < 1:
         return _error(
-            e,
+            e.to_json(),
+            f"Entity {entity} has no {box} {stress_kind} stress box",
+        )
+    if s.is_checked(box):
+        return _error(
+            e.to_json(),
             (
                 f"Entity {entity} has already used the {box} "
                 f"{stress_kind} stress box"
             ),
         )
     # Otherwise
-    s["checked"].append(box)
-    return _ok(e)
+    s.check(box)
+    return _ok(e.to_json())
 
 
-@cmds.register("absorb_stress")
+@cmds.register("absorb_stress", schema=AbsorbStress)
+@coalescing
 @implicit_edit
 def _absorb_stress(game, cmd):
     g = game["data"]
-    stress_kind = cmd["stress"]
-    amount = int(cmd["amount"])
-    entity = cmd["entity"]
-    e = get_path(g, ["entities", entity])
-    s = get_path(e, ["stress", stress_kind], default=None)
+    stress_kind = cmd.stress
+    amount = cmd.amount
+    entity = cmd.entity
+    e = _entity(g, entity)
+    s = e.stress.get(stress_kind)
     if s is None:
-        return _error(e, f"Entity {entity} has no {stress_kind} stress track")
-    available = [
-        box for box in range(1, s["max"]+1) if box not in s["checked"]
-    ]
+        return _error(
+            e.to_json(),
+            f"Entity {entity} has no {stress_kind} stress track",
+        )
 
-    try:
-        result = next(a for a in available if a >= amount)
-        s["checked"].append(result)
-        return _ok(e)
+    result = s.first_free(amount)
+    if result is not None:
+        s.check(result)
+        return _ok(e.to_json())
 
-    except StopIteration:
+    else:
         return _error(
-            e,
+            e.to_json(),
             (
                 f"Entity {entity} unable to absorb "
                 f"{amount} {stress_kind} stress with their available "
-                f"stress boxes: {available}"
+                f"stress boxes: {s.available()}"
             ),
         )
 
 
-@cmds.register("clear_stress_box")
+@cmds.register("clear_stress_box", schema=StressBox)
+@coalescing
 @implicit_edit
 def _clear_stress_box(game, cmd):
     g = game["data"]
-    stress_kind = cmd["stress"]
-    box = int(cmd["box"])
-    entity = cmd["entity"]
-    e = get_path(g, ["entities", entity])
-    s = get_path(e, ["stress", stress_kind], default=None)
+    stress_kind = cmd.stress
+    box = cmd.box
+    entity = cmd.entity
+    e = _entity(g, entity)
+    s = e.stress.get(stress_kind)
     if s is None:
-        return _error(e, f"Entity {entity} has no stress track {stress_kind}")
-    if box > s["max"]:
         return _error(
-            e,
+            e.to_json(),
+            f"Entity {entity} has no stress track {stress_kind}",
+        )
+    if box > s.max or box < 1:
+        return _error(
+            e.to_json(),
             (
                 f"Entity {entity} does not have a {box} {stress_kind} "
                 f"stress box at all"
             ),
         )
-    if box not in s["checked"]:
+    if not s.is_checked(box):
         return _error(
-            e,
+            e.to_json(),
             (
                 f"Entity {entity} doesn't have the {box} "
                 f"{stress_kind} stress box checked"
             ),
         )
     # Otherwise
-    s["checked"] = [b for b in s["checked"] if b != box]
-    return _ok(e)
+    s.clear(box)
+    return _ok(e.to_json())
 
 
-@cmds.register("clear_all_stress")
+@cmds.register("clear_all_stress", lane=BULK)
 @implicit_edit
 def _clear_all_stress(game, cmd):
     # Stress tracks that do not get auto-cleared
@@ -572,49 +709,116 @@ def _clear_all_stress(game, cmd):
         "hunger",
     ]
     g = game["data"]
-    if "entities" not in g:
-        g["entities"] = {}
-    entities = get_path(g, ["entities"])
-    for entity in entities:
-        e = entities[entity]
-        for s in e["stress"]:
-            if s in do_not_clear:
+    for e in g.entities.values():
+        for (kind, s) in e.stress.items():
+            if kind in do_not_clear:
                 continue
-            e["stress"][s]["checked"] = []
-    return _ok(entities)
+            s.clear_all()
+    return _ok(g.entities_json())
 
 
-def _default_order():
-    default_order = {}
-    default_order["entities"] = []
-    default_order["bonuses"] = {}
-    default_order["order"] = []
-    default_order["current"] = None
-    default_order["deferred"] = []
-    return default_order
+#
+# Bulk variants
+#
+
+
+def _select(g, selector):
+    """
+    The names of the entities matching `selector`, in the state's order, or
+    in the order of its `names`.  Names of missing entities are kept, to be
+    reported as such.
+    """
+    in_order = g.order.entities if g.order is not None else {}
+    names = selector.names if selector.names is not None else g.entities
+    selected = []
+    for name in names:
+        e = g.entities.get(name)
+        if e is not None and not (
+            (selector.is_pc is None or e.is_pc == selector.is_pc)
+            and (
+                selector.has_aspect is None
+                or e.aspects.get(selector.has_aspect)
+            )
+            and (
+                selector.in_order is None
+                or (name in in_order) == selector.in_order
+            )
+        ):
+            continue
+        selected.append(name)
+    return selected
+
+
+def bulk_variant(name, schema):
+    """
+    Register `bulk_<name>`, which runs command `name` on each entity matched
+    by the `select` field of its arguments, all in a single edit.
+
+    The other fields of `schema` are passed on to `name` as they are.  The
+    result maps each matched entity to its own result.
+    """
+
+    @cmds.register(f"bulk_{name}", schema=schema, lane=BULK)
+    @implicit_edit
+    def _bulk(game, cmd):
+        g = game["data"]
+        single = cmds.get(name).__wrapped__
+        single_schema = cmds.schemas[name]
+        args = {
+            f.name: getattr(cmd, f.name)
+            for f in fields(cmd)
+            if f.name != "select"
+        }
+        selected = _select(g, cmd.select)
+        if not selected:
+            return _error(asdict(cmd.select), "No entities match")
+        results = {}
+        for entity in selected:
+            if entity not in g.entities:
+                results[entity] = _error(entity, f"No such entity '{entity}'")
+                continue
+            results[entity] = single(
+                game, single_schema(entity=entity, **args)
+            )
+        return _ok(results)
+
+    return _bulk
+
+
+bulk_variant("add_stress", BulkStressBox)
+bulk_variant("absorb_stress", BulkAbsorbStress)
+bulk_variant("add_aspect", BulkAddAspect)
+bulk_variant("set_fp", BulkSetFp)
+bulk_variant("refresh_fp", BulkEntities)
 
 
 def _ensure_order(g):
-    if "order" not in g:
-        g["order"] = _default_order()
+    if g.order is None:
+        g.order = Initiative()
+
 
+def _order_or_empty(g):
+    # For commands that can't start an order, so that they don't add one
+    return g.order if g.order is not None else Initiative()
 
-@cmds.register("order_add")
+
+@cmds.register("order_add", schema=OrderAdd)
 @implicit_edit
 def _order_add(game, cmd):
     g = game["data"]
-    entity = cmd["entity"]
-    bonus = int(cmd["bonus"])
-    e = get_path(g, ["entities", entity])
+    additions = dict(cmd.entities)
+    if cmd.entity is not None:
+        additions[cmd.entity] = cmd.bonus
+    missing = [name for name in additions if name not in g.entities]
+    if missing:
+        return _error(
+            list(g.entities.keys()),
+            f"Cannot add missing entities to the order: {', '.join(missing)}",
+        )
     _ensure_order(g)
-    g["order"]["entities"] = list(
-        set(g["order"]["entities"]).union({entity})
-    )
-    g["order"]["deferred"] = list(
-        set(g["order"]["deferred"]).union({entity})
-    )
-    g["order"]["bonuses"][entity] = bonus
-    return _ok(g["order"])
+    for (entity, bonus) in additions.items():
+        g.order.add(entity, bonus)
+    return _ok(g.order.to_json())
 
 
 @cmds.register("next")
@@ -622,13 +826,8 @@ def _order_add(game, cmd):
 def _next(game, cmd):
     g = game["data"]
     _ensure_order(g)
-    if g["order"]["current"] is not None and g["order"]["order"]:
-        g["order"]["current"] = (
-            (g["order"]["current"] + 1) % len(g["order"]["order"])
-        )
-    else:
-        _start_order(game, {})
-    return _ok(g["order"])
+    g.order.advance()
+    return _ok(g.order.to_json())
 
 
 @cmds.register("back")
@@ -636,71 +835,48 @@ def _next(game, cmd):
 def _back(game, cmd):
     g = game["data"]
     _ensure_order(g)
-    if g["order"]["current"] is not None and g["order"]["order"]:
-        g["order"]["current"] = (
-            (g["order"]["current"] - 1) % len(g["order"]["order"])
-        )
-    else:
-        _start_order(game, {})
-    return _ok(g["order"])
+    g.order.retreat()
+    return _ok(g.order.to_json())
 
 
-@cmds.register("drop_from_order")
+@cmds.register("drop_from_order", schema=OptionalEntity)
 @implicit_edit
 def _drop_from_order(game, cmd):
     g = game["data"]
-    entity = cmd.get("entity")
-    _ensure_order(g)
-    if g["order"]["current"] is not None and g["order"]["order"]:
-        if not entity:
-            current = g["order"]["current"]
-            entity = g["order"]["order"][current]
-        g["order"]["entities"].remove(entity)
-        g["order"]["order"].remove(entity)
-        g["order"]["current"] = (
-            g["order"]["current"] % len(g["order"]["order"])
-        )
-    return _ok(g["order"])
+    entity = cmd.entity
+    order = _order_or_empty(g)
+    if order.is_running():
+        order.drop(entity or None)
+    return _ok(order.to_json())
 
 
 @cmds.register("defer")
 @implicit_edit
 def _order_defer(game, cmd):
     g = game["data"]
-    _ensure_order(g)
-    if len(g["order"]["order"]) <= 1:
+    order = _order_or_empty(g)
+    if len(order) <= 1:
         return _error(
-            g["order"],
+            order.to_json(),
             f"Can't defer, or nobody will be in the turn order!",
         )
-    if g["order"]["current"] is not None and g["order"]["order"]:
-        current = g["order"]["current"]
-        active = g["order"]["order"][current]
-        g["order"]["deferred"].append(active)
-        g["order"]["order"].remove(active)
-        g["order"]["current"] = (
-            g["order"]["current"] % len(g["order"]["order"])
-        )
-    return _ok(g["order"])
+    order.defer()
+    return _ok(order.to_json())
 
 
-@cmds.register("undefer")
+@cmds.register("undefer", schema=EntityArgs)
 @implicit_edit
 def _order_undefer(game, cmd):
     g = game["data"]
-    _ensure_order(g)
-    entity = cmd.get("entity")
-    if entity not in g["order"]["deferred"]:
-        return _error(g["order"], f"Entity '{entity}' has not deferred")
-
-    if g["order"]["current"] is not None and g["order"]["order"]:
-        current = g["order"]["current"]
-        g["order"]["order"].insert(current, entity)
-        g["order"]["deferred"].remove(entity)
-        g["order"]["current"] = (
-            g["order"]["current"] % len(g["order"]["order"])
+    order = _order_or_empty(g)
+    entity = cmd.entity
+    if entity not in order.deferred:
+        return _error(
+            order.to_json(),
+            f"Entity '{entity}' has not deferred",
         )
-    return _ok(g["order"])
+    order.undefer(entity)
+    return _ok(order.to_json())
 
 
 @cmds.register("start_order")
@@ -708,40 +884,51 @@ def _order_undefer(game, cmd):
 def _start_order(game, cmd):
     g = game["data"]
     _ensure_order(g)
-    g["order"]["order"] = sorted(
-        g["order"]["entities"],
-        key=lambda x: (g["order"]["bonuses"].get(x, 0), random.random()),
-        reverse=True,
-    )
-    g["order"]["deferred"] = []
-    g["order"]["current"] = 0
-    return _ok(g["order"])
+    g.order.start()
+    return _ok(g.order.to_json())
 
 
 @cmds.register("clear_order")
 @implicit_edit
 def _clear_order(game, cmd):
     g = game["data"]
-    g["order"] = _default_order()
-    return _ok(g["order"])
+    if g.order is None:
+        return _ok(Initiative().to_json())
+    # Not a change if it is already empty (see `Initiative.__eq__`)
+    g.order = Initiative()
+    return _ok(g.order.to_json())
 
 
-@cmds.register("overwrite_state")
+@cmds.register("overwrite_state", schema=OverwriteState, lane=BULK)
 @implicit_edit
 def _overwrite_state(game, cmd):
-    game["data"] = cmd["state"]
-    return _ok(game["data"])
+    try:
+        game["data"] = Game.from_json(cmd.state)
+    except InvalidState as err:
+        return _error(cmd.state, str(err))
+    return _ok(game["data"].to_json())
 
 
-@cmds.register("implicit_test")
+@cmds.register("restore_checkpoint", schema=RestoreCheckpoint)
+@serialized
+def _restore_checkpoint(cmd):
+    # Copies the stored state, rather than editing the live one
+    try:
+        committed = database.restore(cmd.checkpoint)
+    except ValueError as err:
+        return _error(cmd.checkpoint, str(err))
+    return _ok({"checkpoint": committed, "restored": cmd.checkpoint})
+
+
+@cmds.register("implicit_test", schema=Test)
 def _implicit_test(cmd):
-    return _ok(cmd)
+    return _ok(asdict(cmd))
 
 
-@cmds.register("test")
+@cmds.register("test", schema=Test)
 @implicit_edit
 def _test(game, cmd):
-    return _ok(cmd.get("string", "foo"))
+    return _ok(cmd.string)
 
 
 #
@@ -753,24 +940,122 @@ stream = "commands"
 
 
 def commands_incoming():
+    lasts = start_consuming()
     while True:
-        yield from wait_for_commands()
-
-
-def main_loop():
-    last = "$"
+        for (lane, entry_id, command) in wait_for_commands(lasts):
+            lasts[lane] = entry_id
+            yield (lane, entry_id, command)
+
+
+# How many read-only commands may run at once
+read_concurrency = int(os.environ.get("WORKER_READ_CONCURRENCY", "8"))
+
+# How long to wait for more of the same command on the same entity, to
+# commit them together (see `run_coalesced`), in milliseconds.  Off if 0.
+coalesce_window = int(os.environ.get("WORKER_COALESCE_MS", "0")) / 1000
+
+
+async def main_loop():
+    """
+    Read commands from the stream, and run them.
+
+    Mutating commands are run one at a time by a single writer: in stream
+    order within each lane, and interactive commands ahead of bulk ones (see
+    `lanes`).  Read-only commands run alongside the writer and each other, so
+    they never wait behind a slow edit; they must not touch the live state.
+    With a `coalesce_window`, a run of the same edit to the same entity is
+    committed as one checkpoint.
+
+    All blocking storage calls run in threads.  Results are stored in the
+    background, so the writer moves on to the next command (and the reader
+    to the next batch) while the previous result is still being saved.
+    """
+    writes = Scheduler()
+    reads = asyncio.Semaphore(read_concurrency)
+    background = set()
+
+    def in_background(coroutine):
+        task = asyncio.create_task(coroutine)
+        # The event loop only keeps weak references to its tasks
+        background.add(task)
+        task.add_done_callback(background.discard)
+        return task
+
+    async def finish(key, command, trace, result):
+        stored = tracing.attach(result, trace)
+        try:
+            await asyncio.to_thread(store_result, stored, key)
+        except Exception as err:
+            print(f"main | failed to store result for {key}: {err!r}")
+        trace_id = trace.id if trace is not None else None
+        print(f"main | {trace_id} | {command} | {result}")
+
+    async def coalesced(first):
+        # `first`, and whatever comes next in the window with the same key
+        batch = [first]
+        group = coalescing_key(first[1])
+        if not coalesce_window or group is None:
+            return batch
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + coalesce_window
+
+        def same(item):
+            return coalescing_key(item[1]) == group
+
+        while True:
+            found = writes.take_if(same)
+            if found is not None:
+                batch.append(found)
+                continue
+            remaining = deadline - loop.time()
+            if len(writes) or remaining <= 0:
+                # Something else is next, or time's up
+                return batch
+            await writes.wait(remaining)
+
+    async def writer():
+        while True:
+            batch = await coalesced(await writes.get())
+            if len(batch) == 1:
+                [(key, command, trace)] = batch
+                results = [
+                    await asyncio.to_thread(run_command, command, trace)
+                ]
+            else:
+                results = await asyncio.to_thread(
+                    run_coalesced,
+                    [command for (_, command, _) in batch],
+                    [trace for (_, _, trace) in batch],
+                )
+            for ((key, command, trace), result) in zip(batch, results):
+                in_background(finish(key, command, trace, result))
+
+    async def reader(key, command, trace):
+        async with reads:
+            result = await asyncio.to_thread(run_command, command, trace)
+        await finish(key, command, trace, result)
+
+    in_background(writer())
+    lasts = await asyncio.to_thread(start_consuming)
     while True:
-        for (entry_id, command) in wait_for_commands(last):
-            res = process_command(command, entry_id=entry_id)
-            print(f"main | {command} | {res}")
-            last = entry_id
+        entries = await asyncio.to_thread(
+            lambda: list(wait_for_commands(lasts))
+        )
+        for (lane, entry_id, command) in entries:
+            key = result_key(lane, entry_id)
+            trace = tracing.received(command)
+            if cmds.mutates(command):
+                writes.put(lane, (key, command, trace))
+            else:
+                in_background(reader(key, command, trace))
+            lasts[lane] = entry_id
 
 
 def main():
     checkpoint = database.get_checkpoint()
     print(f"Loading from checkpoint {checkpoint}.")
     print("Reading stream...")
-    main_loop()
+    asyncio.run(main_loop())
 
 
 if __name__ == "__main__":
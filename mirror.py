@@ -0,0 +1,84 @@
+import threading
+import time
+
+
+class StateMirror:
+    """
+    A copy of the current state, kept in memory by each HTTP process.
+
+    A background thread listens for notifications that the current checkpoint
+    changed (see `StorageBackend.watch_pointer`), and drops the copy when one
+    arrives; the next read loads the new state once, and later reads are
+    served from memory without touching storage.
+
+    Whenever the notifications aren't being received (not yet subscribed, the
+    connection dropped, or the backend has none), every read goes to storage
+    instead.  Callers share the mirrored state, and must not modify it.
+    """
+
+    def __init__(self, load, watch, retry=1.0):
+        # `load` returns (checkpoint, state) as currently stored
+        self.load = load
+        # `watch` returns None if there are no notifications
+        self.watch = watch
+        self.retry = retry
+        self.current = None
+        self.listening = False
+        # Bumped by every notification, so a read that raced one isn't kept
+        self.version = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.notifications = 0
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._listen, daemon=True)
+            self.thread.start()
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.current = None
+
+    def _listen(self):
+        while True:
+            try:
+                events = self.watch()
+                if events is None:
+                    print("mirror | no change notifications, reading directly")
+                    return
+                for _ in events:
+                    self.invalidate()
+                    self.notifications += 1
+                    self.listening = True
+            except Exception as err:
+                print(f"mirror | notifications failed: {err!r}")
+            self.listening = False
+            self.invalidate()
+            time.sleep(self.retry)
+
+    def get(self):
+        """
+        Return (checkpoint, state) for the current checkpoint.
+        """
+        current = self.current
+        if self.listening and current is not None:
+            self.hits += 1
+            return current
+        self.misses += 1
+        version = self.version
+        found = self.load()
+        with self.lock:
+            if self.listening and self.version == version:
+                self.current = found
+        return found
+
+    def stats(self):
+        return {
+            "listening": self.listening,
+            "hits": self.hits,
+            "misses": self.misses,
+            "notifications": self.notifications,
+        }
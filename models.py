@@ -0,0 +1,360 @@
+from aspects import AspectIndex
+from initiative import Initiative
+from tracking import TrackedDict
+from tracking import tracked_setattr
+
+
+#
+# In-memory game model
+#
+# The worker's handlers operate on these rather than on the decoded JSON.
+# Each class round-trips through `from_json`/`to_json` to exactly the stored
+# JSON shape; keys the model doesn't know about are carried along in `extra`,
+# and known keys that were absent stay absent until they get a value.
+#
+# Objects that are part of a game know their JSON `path` within it, and report
+# their mutations to `tracking.changes`.
+#
+
+
+class InvalidState(ValueError):
+    """
+    Stored or submitted state that the model can't represent.
+    """
+
+
+def _is_int(value):
+    # bool is an int subclass, but `True` as a stress box is a mistake
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class Aspect:
+
+    __slots__ = ("name", "kind", "tags", "extra", "owner")
+
+    def __init__(self, name, kind=None, tags=None, extra=None):
+        self.owner = None
+        self.name = name
+        self.kind = kind
+        self.tags = tags
+        self.extra = extra
+
+    def __setattr__(self, name, value):
+        # Aspects live in a list, so any change marks the whole list
+        if name != "owner" and self.owner is not None:
+            if getattr(self, name) != value:
+                self.owner.touch()
+        object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Raises `InvalidState` unless `data` is an object with a string name.
+        """
+        if not isinstance(data, dict):
+            raise InvalidState(f"Aspect must be an object: {data!r}")
+        if not isinstance(data.get("name"), str):
+            raise InvalidState(f"Aspect must have a string name: {data!r}")
+        extra = {
+            k: v for (k, v) in data.items()
+            if k not in ("name", "kind", "tags")
+        }
+        return cls(
+            data["name"],
+            kind=data.get("kind"),
+            tags=data.get("tags"),
+            extra=extra or None,
+        )
+
+    def to_json(self):
+        result = {"name": self.name}
+        if self.kind is not None:
+            result["kind"] = self.kind
+        if self.tags is not None:
+            result["tags"] = self.tags
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+
+class StressTrack:
+    """
+    A stress track, with the checked boxes held as a bitset.
+
+    Bit `b` of `boxes` is set when box `b` is checked.
+    """
+
+    __slots__ = ("max", "boxes", "extra", "absent", "path")
+
+    json_names = {"boxes": "checked", "extra": None}
+
+    __setattr__ = tracked_setattr
+
+    def __init__(self, max_, boxes=0, extra=None, absent=()):
+        self.path = None
+        self.max = max_
+        self.boxes = boxes
+        self.extra = extra
+        self.absent = absent
+
+    def attach(self, path):
+        self.path = path
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Raises `InvalidState` unless `max` is a non-negative int, and the
+        checked boxes are ints.  Checked boxes past `max` are dropped, as
+        states stored before `max` was lowered may have them.
+        """
+        if not isinstance(data, dict):
+            raise InvalidState(f"Stress track must be an object: {data!r}")
+        max_ = data.get("max")
+        if not _is_int(max_) or max_ < 0:
+            raise InvalidState(
+                f"Stress track max must be a non-negative int: {max_!r}"
+            )
+        checked = data.get("checked", [])
+        if not isinstance(checked, list):
+            raise InvalidState(f"Checked boxes must be a list: {checked!r}")
+        boxes = 0
+        for box in checked:
+            if not _is_int(box):
+                raise InvalidState(f"Stress box must be an int: {box!r}")
+            if 0 <= box <= max_:
+                boxes |= 1 << box
+        extra = {
+            k: v for (k, v) in data.items() if k not in ("checked", "max")
+        }
+        absent = () if "checked" in data else ("checked",)
+        return cls(max_, boxes, extra=extra or None, absent=absent)
+
+    def to_json(self):
+        result = {}
+        if self.boxes or "checked" not in self.absent:
+            result["checked"] = self.checked()
+        result["max"] = self.max
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+    def checked(self):
+        boxes = self.boxes
+        result = []
+        while boxes:
+            low = boxes & -boxes
+            result.append(low.bit_length() - 1)
+            boxes ^= low
+        return result
+
+    def is_checked(self, box):
+        return bool(self.boxes >> box & 1)
+
+    def check(self, box):
+        self.boxes |= 1 << box
+
+    def clear(self, box):
+        self.boxes &= ~(1 << box)
+
+    def clear_all(self):
+        self.boxes = 0
+
+    def resize(self, max_):
+        """
+        Set `max`, clearing any checked boxes past it.
+        """
+        self.max = max_
+        self.boxes &= (1 << (max_ + 1)) - 1
+
+    def available(self):
+        return [
+            box for box in range(1, self.max + 1)
+            if not self.is_checked(box)
+        ]
+
+    def first_free(self, at_least):
+        """
+        Return the smallest unchecked box of at least `at_least`, or None.
+        """
+        at_least = max(at_least, 1)
+        if at_least > self.max:
+            return None
+        # Boxes at_least..max, minus the checked ones
+        window = ((1 << (self.max + 1)) - 1) & ~((1 << at_least) - 1)
+        free = window & ~self.boxes
+        if not free:
+            return None
+        return (free & -free).bit_length() - 1
+
+
+class Entity:
+
+    __slots__ = (
+        "name",
+        "fate",
+        "refresh",
+        "aspects",
+        "stress",
+        "is_pc",
+        "portrait",
+        "extra",
+        "absent",
+        "path",
+    )
+
+    json_names = {"extra": None}
+
+    __setattr__ = tracked_setattr
+
+    known = (
+        "name",
+        "fate",
+        "refresh",
+        "aspects",
+        "stress",
+        "is_pc",
+        "portrait",
+    )
+
+    def __init__(
+        self,
+        name,
+        fate=0,
+        refresh=0,
+        aspects=None,
+        stress=None,
+        is_pc=False,
+        portrait=None,
+        extra=None,
+        absent=(),
+    ):
+        self.path = None
+        self.name = name
+        self.fate = fate
+        self.refresh = refresh
+        self.aspects = aspects if aspects is not None else AspectIndex()
+        self.stress = TrackedDict(None, stress or {})
+        self.is_pc = is_pc
+        self.portrait = portrait
+        self.extra = extra
+        # Known keys missing from the JSON this was loaded from
+        self.absent = absent
+
+    def attach(self, path):
+        self.path = path
+        self.aspects.attach(path + ("aspects",))
+        self.stress.attach(path + ("stress",))
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Raises `InvalidState` unless `data` is an object with int `fate` and
+        `refresh`, a list of `aspects` and an object of `stress` tracks, where
+        present.
+        """
+        if not isinstance(data, dict):
+            raise InvalidState(f"Entity must be an object: {data!r}")
+        for key in ("fate", "refresh"):
+            if key in data and not _is_int(data[key]):
+                raise InvalidState(
+                    f"Entity {key} must be an int: {data[key]!r}"
+                )
+        if not isinstance(data.get("aspects", []), list):
+            raise InvalidState(f"Aspects must be a list: {data['aspects']!r}")
+        if not isinstance(data.get("stress", {}), dict):
+            raise InvalidState(f"Stress must be an object: {data['stress']!r}")
+        extra = {k: v for (k, v) in data.items() if k not in cls.known}
+        return cls(
+            data.get("name"),
+            fate=data.get("fate", 0),
+            refresh=data.get("refresh", 0),
+            aspects=AspectIndex(
+                Aspect.from_json(a) for a in data.get("aspects", [])
+            ),
+            stress={
+                k: StressTrack.from_json(s)
+                for (k, s) in data.get("stress", {}).items()
+            },
+            is_pc=data.get("is_pc", False),
+            portrait=data.get("portrait"),
+            extra=extra or None,
+            absent=tuple(k for k in cls.known if k not in data),
+        )
+
+    def to_json(self):
+        result = {} if self.name is None else {"name": self.name}
+        fields = {
+            "fate": self.fate,
+            "refresh": self.refresh,
+            "aspects": self.aspects.to_json(),
+            "stress": {k: s.to_json() for (k, s) in self.stress.items()},
+            "is_pc": self.is_pc,
+        }
+        for (key, value) in fields.items():
+            # Defaults are all falsy, and aren't added where they were absent
+            if value or key not in self.absent:
+                result[key] = value
+        if self.portrait is not None:
+            result["portrait"] = self.portrait
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+
+class Game:
+
+    __slots__ = ("entities", "order", "extra", "absent", "path")
+
+    json_names = {"extra": None}
+
+    __setattr__ = tracked_setattr
+
+    def __init__(self, entities=None, order=None, extra=None, absent=()):
+        self.path = ()
+        self.entities = TrackedDict(("entities",), entities or {})
+        self.order = order
+        self.extra = extra
+        self.absent = absent
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Raises `InvalidState` unless `data` is an object, with an object of
+        `entities` where present.
+        """
+        data = data or {}
+        if not isinstance(data, dict):
+            raise InvalidState(f"State must be an object: {data!r}")
+        entities = data.get("entities", {})
+        if not isinstance(entities, dict):
+            raise InvalidState(f"Entities must be an object: {entities!r}")
+        extra = {
+            k: v for (k, v) in data.items()
+            if k not in ("entities", "order")
+        }
+        return cls(
+            entities={
+                name: Entity.from_json(e)
+                for (name, e) in entities.items()
+            },
+            order=(
+                Initiative.from_json(data["order"])
+                if data.get("order") is not None
+                else None
+            ),
+            extra=extra or None,
+            absent=() if "entities" in data else ("entities",),
+        )
+
+    def to_json(self):
+        result = {}
+        if self.entities or "entities" not in self.absent:
+            result["entities"] = self.entities_json()
+        if self.order is not None:
+            result["order"] = self.order.to_json()
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+    def entities_json(self):
+        return {name: e.to_json() for (name, e) in self.entities.items()}
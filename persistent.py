@@ -0,0 +1,294 @@
+#
+# Persistent (immutable, structure-sharing) containers for JSON-like data
+#
+# `PMap` is a hash array mapped trie: updates copy only the path from the root
+# to the changed entry, and share everything else with the original.  Lists
+# are frozen into tuples, which are shared whole when unchanged.
+#
+
+
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_BITS = 64
+
+
+def _hash(key):
+    return hash(key) & ((1 << _HASH_BITS) - 1)
+
+
+class _Node:
+
+    __slots__ = ("bitmap", "entries")
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        # Each entry is a (key, value) pair, a child _Node, or a _Bucket
+        self.entries = entries
+
+
+class _Bucket:
+    """
+    Pairs whose keys have identical full hashes.
+    """
+
+    __slots__ = ("pairs",)
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+
+_EMPTY = _Node(0, ())
+
+
+def _merge(shift, pair1, h1, pair2, h2):
+    if shift >= _HASH_BITS:
+        return _Bucket((pair1, pair2))
+    b1 = (h1 >> shift) & _MASK
+    b2 = (h2 >> shift) & _MASK
+    if b1 == b2:
+        return _Node(1 << b1, (_merge(shift + _BITS, pair1, h1, pair2, h2),))
+    if b1 < b2:
+        return _Node((1 << b1) | (1 << b2), (pair1, pair2))
+    return _Node((1 << b1) | (1 << b2), (pair2, pair1))
+
+
+def _assoc(node, shift, h, key, value):
+    """
+    Return (new node, whether a key was added).
+    """
+    if isinstance(node, _Bucket):
+        pairs = [p for p in node.pairs if p[0] != key]
+        added = len(pairs) == len(node.pairs)
+        return (_Bucket(tuple(pairs) + ((key, value),)), added)
+
+    bit = 1 << ((h >> shift) & _MASK)
+    idx = (node.bitmap & (bit - 1)).bit_count()
+    entries = node.entries
+
+    if not node.bitmap & bit:
+        new = entries[:idx] + ((key, value),) + entries[idx:]
+        return (_Node(node.bitmap | bit, new), True)
+
+    entry = entries[idx]
+    if isinstance(entry, (_Node, _Bucket)):
+        (child, added) = _assoc(entry, shift + _BITS, h, key, value)
+        replacement = child
+    elif entry[0] == key:
+        if entry[1] is value:
+            return (node, False)
+        (replacement, added) = ((key, value), False)
+    else:
+        replacement = _merge(
+            shift + _BITS,
+            entry,
+            _hash(entry[0]),
+            (key, value),
+            h,
+        )
+        added = True
+    new = entries[:idx] + (replacement,) + entries[idx + 1:]
+    return (_Node(node.bitmap, new), added)
+
+
+def _dissoc(node, shift, h, key):
+    """
+    Return the new node (None if it became empty), or `node` if `key` absent.
+    """
+    if isinstance(node, _Bucket):
+        pairs = tuple(p for p in node.pairs if p[0] != key)
+        if len(pairs) == len(node.pairs):
+            return node
+        return _Bucket(pairs) if pairs else None
+
+    bit = 1 << ((h >> shift) & _MASK)
+    if not node.bitmap & bit:
+        return node
+    idx = (node.bitmap & (bit - 1)).bit_count()
+    entry = node.entries[idx]
+
+    if isinstance(entry, (_Node, _Bucket)):
+        child = _dissoc(entry, shift + _BITS, h, key)
+        if child is entry:
+            return node
+    elif entry[0] == key:
+        child = None
+    else:
+        return node
+
+    if child is None:
+        bitmap = node.bitmap & ~bit
+        if not bitmap:
+            return None
+        entries = node.entries[:idx] + node.entries[idx + 1:]
+    else:
+        bitmap = node.bitmap
+        entries = node.entries[:idx] + (child,) + node.entries[idx + 1:]
+    return _Node(bitmap, entries)
+
+
+def _lookup(node, shift, h, key, default):
+    while True:
+        if isinstance(node, _Bucket):
+            for (k, v) in node.pairs:
+                if k == key:
+                    return v
+            return default
+        bit = 1 << ((h >> shift) & _MASK)
+        if not node.bitmap & bit:
+            return default
+        entry = node.entries[(node.bitmap & (bit - 1)).bit_count()]
+        if isinstance(entry, (_Node, _Bucket)):
+            node = entry
+            shift += _BITS
+        elif entry[0] == key:
+            return entry[1]
+        else:
+            return default
+
+
+def _walk(node):
+    if isinstance(node, _Bucket):
+        yield from node.pairs
+        return
+    for entry in node.entries:
+        if isinstance(entry, (_Node, _Bucket)):
+            yield from _walk(entry)
+        else:
+            yield entry
+
+
+_MISSING = object()
+
+
+class PMap:
+    """
+    An immutable mapping.  `set` and `delete` return new maps that share all
+    unchanged structure with the original.
+    """
+
+    __slots__ = ("root", "size")
+
+    def __init__(self, root=_EMPTY, size=0):
+        self.root = root
+        self.size = size
+
+    @classmethod
+    def from_items(cls, items):
+        result = cls()
+        for (k, v) in items:
+            result = result.set(k, v)
+        return result
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for (k, _) in _walk(self.root):
+            yield k
+
+    def __contains__(self, key):
+        return _lookup(self.root, 0, _hash(key), key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = _lookup(self.root, 0, _hash(key), key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return _lookup(self.root, 0, _hash(key), key, default)
+
+    def items(self):
+        return _walk(self.root)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for (_, v) in _walk(self.root):
+            yield v
+
+    def set(self, key, value):
+        (root, added) = _assoc(self.root, 0, _hash(key), key, value)
+        if root is self.root:
+            return self
+        return PMap(root, self.size + (1 if added else 0))
+
+    def delete(self, key):
+        root = _dissoc(self.root, 0, _hash(key), key)
+        if root is self.root:
+            return self
+        return PMap(root if root is not None else _EMPTY, self.size - 1)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, PMap):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        return all(
+            other.get(k, _MISSING) == v for (k, v) in self.items()
+        )
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"PMap({dict(self.items())!r})"
+
+
+#
+# Conversion to and from plain JSON values
+#
+
+
+def freeze(value):
+    """
+    Convert a JSON value into persistent containers.
+    """
+    if isinstance(value, dict):
+        return PMap.from_items((k, freeze(v)) for (k, v) in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    else:
+        return value
+
+
+def thaw(value):
+    """
+    Convert persistent containers back into a plain JSON value.
+    """
+    if isinstance(value, PMap):
+        return {k: thaw(v) for (k, v) in value.items()}
+    elif isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    else:
+        return value
+
+
+def assoc_in(pmap, path, value):
+    """
+    Return `pmap` with the (already frozen) `value` placed at `path`.
+
+    Missing intermediate maps are created.
+    """
+    if not path:
+        return value
+    (key, *rest) = path
+    child = pmap.get(key)
+    if rest and not isinstance(child, PMap):
+        child = PMap()
+    return pmap.set(key, assoc_in(child, rest, value))
+
+
+def dissoc_in(pmap, path):
+    """
+    Return `pmap` without whatever is at `path`.
+    """
+    (key, *rest) = path
+    if not rest:
+        return pmap.delete(key)
+    child = pmap.get(key)
+    if not isinstance(child, PMap):
+        return pmap
+    return pmap.set(key, dissoc_in(child, rest))
@@ -0,0 +1,96 @@
+#
+# Projections of the state
+#
+# Parts of the state are picked out by paths in its stored JSON layout,
+# "/"-separated, as in "entities/Rayne/stress" or "order".  A "*" part
+# matches every key at that level, as in "entities/*/stress".
+#
+# Projections never modify the state they are given, which may be shared
+# (see `mirror`): what they return is new only along the paths, and shares
+# everything else.
+#
+
+from utils import UNSET
+
+
+def parse_path(path):
+    return tuple(part for part in path.strip("/").split("/") if part)
+
+
+def _by_key(paths):
+    # The remainder of each path, grouped by its first part
+    grouped = {}
+    for path in paths:
+        grouped.setdefault(path[0], []).append(path[1:])
+    return grouped
+
+
+def include(data, paths):
+    """
+    Only the parts of `data` at `paths`, with the structure above them.
+
+    Returns `UNSET` if `data` can't have any of them.
+    """
+    if any(not path for path in paths):
+        return data
+    if not isinstance(data, dict):
+        return UNSET
+    grouped = _by_key(paths)
+    wild = grouped.pop("*", [])
+    keys = data if wild else [key for key in grouped if key in data]
+    result = {}
+    for key in keys:
+        found = include(data[key], grouped.get(key, []) + wild)
+        if found is not UNSET:
+            result[key] = found
+    return result
+
+
+def exclude(data, paths):
+    """
+    `data` without the parts at `paths`.
+
+    Returns `UNSET` if all of it is excluded.
+    """
+    if any(not path for path in paths):
+        return UNSET
+    if not isinstance(data, dict):
+        return data
+    grouped = _by_key(paths)
+    wild = grouped.pop("*", [])
+    if not wild and not any(key in data for key in grouped):
+        return data
+    result = {}
+    for (key, value) in data.items():
+        below = grouped.get(key, []) + wild
+        found = exclude(value, below) if below else value
+        if found is not UNSET:
+            result[key] = found
+    return result
+
+
+def _has_stress(entity):
+    return any(
+        track.get("checked")
+        for track in (entity.get("stress") or {}).values()
+    )
+
+
+def filter_entities(data, names=None, is_pc=None, has_stress=None):
+    """
+    `data` with only the entities matching all of the given criteria: in
+    `names`, with `is_pc` as given, and with (or without) any checked stress
+    boxes.
+    """
+    entities = data.get("entities") or {}
+    if names is not None:
+        candidates = ((n, entities[n]) for n in names if n in entities)
+    else:
+        candidates = entities.items()
+    kept = {
+        name: e
+        for (name, e) in candidates
+        if (is_pc is None or e.get("is_pc", False) == is_pc)
+        and (has_stress is None or _has_stress(e) == has_stress)
+    }
+    return {**data, "entities": kept}
@@ -0,0 +1,341 @@
+from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import fields
+from dataclasses import asdict
+from dataclasses import MISSING
+from dataclasses import is_dataclass
+import typing
+from typing import Any
+from typing import Optional
+
+
+class SchemaError(ValueError):
+    pass
+
+
+#
+# Decoding
+#
+
+
+def _expect(kind, name):
+
+    def _check(value):
+        if not isinstance(value, kind):
+            raise SchemaError(
+                f"Field '{name}' must be {kind.__name__}, got "
+                f"{type(value).__name__}: {value!r}"
+            )
+        return value
+
+    return _check
+
+
+def _to_int(name):
+
+    def _convert(value):
+        # bool is an int subclass, but `True` as a stress box is a mistake,
+        # and `int` would truncate 2.9 to box 2
+        if isinstance(value, bool) or (
+            isinstance(value, float) and not value.is_integer()
+        ):
+            raise SchemaError(f"Field '{name}' must be int, got {value!r}")
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise SchemaError(f"Field '{name}' must be int, got {value!r}")
+
+    return _convert
+
+
+def _to_bool(name):
+
+    def _convert(value):
+        if isinstance(value, str):
+            if value.lower() in ("true", "1", "yes"):
+                return True
+            if value.lower() in ("false", "0", "no", ""):
+                return False
+            raise SchemaError(f"Field '{name}' must be bool, got {value!r}")
+        if not isinstance(value, bool):
+            raise SchemaError(f"Field '{name}' must be bool, got {value!r}")
+        return value
+
+    return _convert
+
+
+def _converter(annotation, name):
+    """
+    Build a function which checks and coerces a value against `annotation`.
+
+    Supports the handful of types used by the command schemas: scalars,
+    `Optional[...]`, `list[...]`, `dict[str, ...]`, `Any`, and nested schema
+    dataclasses.
+    """
+    if annotation is Any:
+        return lambda value: value
+
+    if is_dataclass(annotation):
+        check = _expect(dict, name)
+        nested = compile_schema(annotation)
+        return lambda value: nested(check(value))
+
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+
+    if origin is typing.Union and type(None) in args:
+        (inner,) = [a for a in args if a is not type(None)]
+        convert = _converter(inner, name)
+        return lambda value: None if value is None else convert(value)
+
+    if origin is list:
+        check = _expect(list, name)
+        convert = _converter(args[0], f"{name}[]") if args else None
+
+        def _list(value):
+            check(value)
+            return [convert(v) for v in value] if convert else value
+
+        return _list
+
+    if origin is dict:
+        check = _expect(dict, name)
+        convert = _converter(args[1], f"{name}{{}}") if args else None
+
+        def _dict(value):
+            check(value)
+            if convert is None:
+                return value
+            return {str(k): convert(v) for (k, v) in value.items()}
+
+        return _dict
+
+    if annotation is int:
+        return _to_int(name)
+
+    if annotation is bool:
+        return _to_bool(name)
+
+    if annotation in (str, float, dict, list):
+        return _expect(annotation, name)
+
+    raise TypeError(f"Unsupported annotation for '{name}': {annotation}")
+
+
+def compile_schema(cls):
+    """
+    Precompute the field converters for the dataclass `cls`.
+
+    The compiled decoder is cached on the class, so each schema is only
+    introspected once no matter how many commands are decoded with it.
+    """
+    hints = typing.get_type_hints(cls)
+    known = {f.name for f in fields(cls)}
+    plan = []
+    for f in fields(cls):
+        if f.default is not MISSING:
+            default = lambda f=f: f.default
+        elif f.default_factory is not MISSING:
+            default = f.default_factory
+        else:
+            default = None
+        plan.append((f.name, _converter(hints[f.name], f.name), default))
+
+    def _decode(data):
+        if not isinstance(data, dict):
+            raise SchemaError(f"Command must be an object, got {data!r}")
+        unexpected = [key for key in data if key not in known]
+        if unexpected:
+            listed = ", ".join(repr(key) for key in unexpected)
+            raise SchemaError(f"Unexpected fields: {listed}")
+        kwargs = {}
+        for (name, convert, default) in plan:
+            value = data.get(name)
+            if value is None:
+                if default is None:
+                    raise SchemaError(f"Missing required field '{name}'")
+                kwargs[name] = default()
+            else:
+                kwargs[name] = convert(value)
+        return cls(**kwargs)
+
+    cls.__decoder__ = _decode
+    return _decode
+
+
+def decode(cls, data):
+    decoder = cls.__dict__.get("__decoder__") or compile_schema(cls)
+    return decoder(data)
+
+
+def encode(name, obj):
+    return {"command": name, **asdict(obj)}
+
+
+#
+# Command schemas
+#
+
+
+@dataclass
+class NoArgs:
+    pass
+
+
+@dataclass
+class EntityArgs:
+    entity: str
+
+
+@dataclass
+class CreateEntity:
+    name: str
+    stress_maxes: dict[str, int] = field(default_factory=dict)
+    refresh: int = 0
+    fate: int = 0
+    is_pc: bool = False
+
+
+@dataclass
+class EditEntity:
+    name: str
+    stress_maxes: dict[str, Optional[int]] = field(default_factory=dict)
+    refresh: Optional[int] = None
+    fate: Optional[int] = None
+    is_pc: Optional[bool] = None
+
+
+@dataclass
+class SetEntity:
+    name: str
+    entity_value: dict
+
+
+@dataclass
+class SetPortrait:
+    entity: str
+    portrait_url: str = ""
+
+
+@dataclass
+class AdjustFp:
+    entity: str
+    amount: int = 1
+
+
+@dataclass
+class SetFp:
+    entity: str
+    fp: int
+
+
+@dataclass
+class AddAspect:
+    entity: str
+    name: str
+    kind: Optional[str] = None
+    tags: Optional[int] = None
+
+
+@dataclass
+class NamedAspect:
+    entity: str
+    name: str
+
+
+@dataclass
+class ClearAllConsequences:
+    max_severity: str
+
+
+@dataclass
+class ClearConsequences:
+    entity: str
+    max_severity: str
+
+
+@dataclass
+class StressBox:
+    entity: str
+    stress: str
+    box: int
+
+
+@dataclass
+class AbsorbStress:
+    entity: str
+    stress: str
+    amount: int
+
+
+@dataclass
+class OrderAdd:
+    entity: Optional[str] = None
+    bonus: int = 0
+    # Bulk additions, as a mapping of entity name to bonus
+    entities: dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class OptionalEntity:
+    entity: Optional[str] = None
+
+
+@dataclass
+class OverwriteState:
+    state: dict
+
+
+@dataclass
+class RestoreCheckpoint:
+    checkpoint: int
+
+
+# Which entities a bulk command applies to: those matching all of the given
+# criteria.  An empty selector matches every entity.
+@dataclass
+class Selector:
+    names: Optional[list[str]] = None
+    is_pc: Optional[bool] = None
+    # The name of an aspect they have
+    has_aspect: Optional[str] = None
+    # Whether they are in the turn order
+    in_order: Optional[bool] = None
+
+
+@dataclass
+class BulkEntities:
+    select: Selector
+
+
+@dataclass
+class BulkSetFp:
+    select: Selector
+    fp: int
+
+
+@dataclass
+class BulkAddAspect:
+    select: Selector
+    name: str
+    kind: Optional[str] = None
+    tags: Optional[int] = None
+
+
+@dataclass
+class BulkStressBox:
+    select: Selector
+    stress: str
+    box: int
+
+
+@dataclass
+class BulkAbsorbStress:
+    select: Selector
+    stress: str
+    amount: int
+
+
+@dataclass
+class Test:
+    string: str = "foo"
@@ -1,7 +1,5 @@
 from contextlib import contextmanager
-import glob
 import json
-import os
 import time
 
 from command_stream import insert_command
@@ -28,10 +26,7 @@ stream = "commands"
 
 
 def reset():
-    for x in glob.glob("db-save-*"):
-        os.remove(x)
-    for k in database.redis.keys():
-        database.redis.delete(k)
+    database.reset()
 
 
 def issue(cmd):
@@ -1,31 +1,76 @@
-from fastapi import FastAPI
-from fastapi.testclient import TestClient
-from fastapi.websockets import WebSocket
+#
+# The command channel
+#
+# A WebSocket over which a client can have any number of commands in flight.
+# Each message the client sends is a command tagged with an id of its
+# choosing:
+#
+#     {"id": 7, "command": {"command": "next"}}
+#
+# and each command's response is sent back tagged with the same id, as soon
+# as the worker has stored its result, in whatever order they complete:
+#
+#     {"id": 7, "ok": true, "result": ...}
+#
+# The commands themselves are queued for the worker in the order they were
+# sent, so each one sees the effects of those sent before it.
+#
+# A message with `"trace": true` gets the command's trace in its response
+# (see `tracing`).
+#
 
-app = FastAPI()
+import asyncio
+import json
 
+import litestar
+from litestar import WebSocket
+from litestar.exceptions import WebSocketDisconnect
 
-@app.get("/")
-async def read_main():
-    return {"msg": "Hello World"}
+from errors import _error
 
 
-@app.websocket("/ws")
-async def websocket(websocket: WebSocket):
-    await websocket.accept()
-    await websocket.send_json({"msg": "Hello WebSocket"})
-    await websocket.close()
+def command_channel(submit):
+    """
+    Make the handler for the command channel, which submits each command
+    with the coroutine `submit(command, show_trace, queueing)`, returning
+    the response.  `submit` must hold the lock `queueing` while it queues
+    the command, but not while it awaits the result.
+    """
 
+    @litestar.websocket("/commands/ws")
+    async def _command_channel(socket: WebSocket) -> None:
+        await socket.accept()
+        sending = asyncio.Lock()
+        # Each message's task asks for this before anything else, in the
+        # order the messages arrived, and the lock hands it out in that order
+        queueing = asyncio.Lock()
+        in_flight = set()
 
-def test_read_main():
-    client = TestClient(app)
-    response = client.get("/")
-    assert response.status_code == 200
-    assert response.json() == {"msg": "Hello World"}
+        async def respond(message):
+            (tag, command, show_trace) = (None, None, False)
+            if isinstance(message, dict):
+                (tag, command) = (message.get("id"), message.get("command"))
+                show_trace = bool(message.get("trace"))
+            if isinstance(command, dict):
+                response = await submit(command, show_trace, queueing)
+            else:
+                response = _error(message, "Expected {id, command: {...}}")
+            async with sending:
+                await socket.send_json({"id": tag, **response})
 
+        try:
+            while True:
+                message = await socket.receive_data(mode="text")
+                try:
+                    message = json.loads(message)
+                except ValueError:
+                    # Answered as a malformed message, like any other
+                    pass
+                task = asyncio.create_task(respond(message))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+        except WebSocketDisconnect:
+            for task in in_flight:
+                task.cancel()
 
-def test_websocket():
-    client = TestClient(app)
-    with client.websocket_connect("/ws") as websocket:
-        data = websocket.receive_json()
-        assert data == {"msg": "Hello WebSocket"}
+    return _command_channel
@@ -0,0 +1,687 @@
+#
+# Storage backends
+#
+# Everything the worker and the HTTP processes share (the checkpoint ring, the
+# command queue and the command results) goes through one of these.  Values
+# are passed in and out already JSON-encoded.
+#
+# The backend is chosen with STORAGE_BACKEND:
+#
+# - "redis" (the default) talks to the redis server configured in `db_redis`.
+# - "sqlite" keeps everything in an embedded SQLite database in WAL mode, at
+#   SQLITE_PATH, for single-host deployments.  Every process using it must
+#   see the same file.
+#
+
+from abc import ABC
+from abc import abstractmethod
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+import time
+
+from lanes import INTERACTIVE
+from lanes import LANES
+
+
+class StorageBackend(ABC):
+    """
+    The operations `database` and `command_stream` need from storage.
+
+    Checkpoints live in numbered slots, each holding the encoded state, the
+    time it was written and, optionally, the encoded delta against the
+    previous checkpoint.  A separate pointer names the current slot.
+
+    Change notifications are optional: backends that have them override
+    `watch_pointer` and `watch_results`.
+    """
+
+    #
+    # Checkpoints
+    #
+
+    @abstractmethod
+    def get_pointer(self):
+        ...
+
+    @abstractmethod
+    def set_pointer(self, k):
+        ...
+
+    def watch_pointer(self):
+        """
+        Yield each time the pointer may have changed, in any process: the
+        new pointer, or None once subscribed and after a reset.  Raises if
+        the notifications stop.
+
+        Returns None instead, if the backend has no notifications.
+        """
+        return None
+
+    @abstractmethod
+    def save_checkpoint(self, k, encoded, ts, delta=None):
+        """
+        Write slot `k` in one step: readers see all of it or none of it.
+        """
+
+    @abstractmethod
+    def copy_checkpoint(self, source, k, ts):
+        """
+        Copy slot `source` into slot `k` within storage, with no delta.
+
+        Returns whether `source` existed.
+        """
+
+    @abstractmethod
+    def load_checkpoint(self, k):
+        ...
+
+    @abstractmethod
+    def checkpoint_timestamp(self, k):
+        ...
+
+    @abstractmethod
+    def checkpoint_delta(self, k):
+        ...
+
+    @abstractmethod
+    def checkpoint_stamps(self):
+        """
+        Return (slot, timestamp) for every occupied slot.
+        """
+
+    @abstractmethod
+    def checkpoint_at(self, ts):
+        """
+        Return the slot last written at or before `ts`, or None.
+
+        Looked up in an index of the slots by timestamp, rather than by
+        fetching every slot's timestamp.
+        """
+
+    #
+    # Commands and results
+    #
+
+    @abstractmethod
+    def append_command(self, encoded, lane=INTERACTIVE):
+        """
+        Queue a command in `lane`, and return its entry id there.
+        """
+
+    @abstractmethod
+    def read_commands(self, lasts):
+        """
+        Block until any lane has commands after its entry in `lasts`, a dict
+        of lane to entry id, and return them as (lane, entry id, encoded).
+        """
+
+    @abstractmethod
+    def command_log(self):
+        """
+        Return every queued command, as (lane, entry id, encoded).
+        """
+
+    @abstractmethod
+    def start_consuming(self):
+        """
+        Called by the worker when it starts reading commands.
+
+        Returns the id of the newest entry in each lane, to read after;
+        anything queued before them is abandoned, and no longer counts as
+        pending.
+        """
+
+    @abstractmethod
+    def queue_status(self):
+        """
+        Return the number of commands queued but not yet processed, the time
+        the worker last processed one (or started), and the time a command
+        was last queued when none were pending, each time None if never.
+        """
+
+    @abstractmethod
+    def store_result(self, key, encoded, ttl):
+        """
+        Store a command's result, which also counts it as processed.
+        """
+
+    @abstractmethod
+    def load_result(self, key):
+        ...
+
+    def watch_results(self):
+        """
+        Yield the key of each result as it is stored, in any process, after
+        yielding None once subscribed.  Raises if the notifications stop.
+
+        Returns None instead, if the backend has no notifications.
+        """
+        return None
+
+    #
+    # Undo
+    #
+
+    @abstractmethod
+    def undo_predecessor(self, k):
+        """
+        Return the checkpoint that undoing checkpoint `k` goes back to, if
+        `k` was itself made by an undo, or None.
+        """
+
+    @abstractmethod
+    def set_undo_predecessor(self, k, predecessor):
+        ...
+
+    #
+    # Entity history
+    #
+
+    @abstractmethod
+    def append_history(self, records):
+        """
+        Append encoded change records, given as (entity, encoded), to their
+        entities' history logs, all at once.
+        """
+
+    @abstractmethod
+    def entity_history(self, name):
+        """
+        Return the encoded change records for entity `name`, oldest first.
+        """
+
+    @abstractmethod
+    def reset(self):
+        """
+        Delete everything.
+        """
+
+
+class RedisBackend(StorageBackend):
+
+    def __init__(
+        self,
+        stream="commands",
+        pointer="persist-checkpoint",
+        prefix="",
+    ):
+        # Imported here, so other backends don't need redis configured
+        from db_redis import redis
+        from db_redis import redis_blocking
+
+        self.redis = redis
+        self.redis_blocking = redis_blocking
+        self.stream = stream
+        # The interactive lane keeps the original stream
+        self.streams = {
+            lane: stream if lane == INTERACTIVE else f"{stream}-{lane}"
+            for lane in LANES
+        }
+        self.lanes = {s: lane for (lane, s) in self.streams.items()}
+        self.pointer = pointer
+        self.pointer_channel = f"{pointer}-changed"
+        self.prefix = prefix
+        self.submitted = f"{stream}-submitted"
+        self.processed = f"{stream}-processed"
+        self.processed_at = f"{stream}-processed-at"
+        self.pending_at = f"{stream}-pending-at"
+        self.results_channel = f"{stream}-results"
+        # Sorted set of slots, scored by timestamp
+        self.stamps = f"{prefix}checkpoint-stamps"
+        self.undo_predecessors = f"{prefix}undo-predecessors"
+
+    def _key(self, kind, k):
+        return f"{kind}{self.prefix}db-save-{k}"
+
+    def get_pointer(self):
+        k = self.redis.get(self.pointer)
+        return int(k) if k is not None else None
+
+    def set_pointer(self, k):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(self.pointer, k)
+        pipe.publish(self.pointer_channel, k)
+        pipe.execute()
+
+    def _subscribe(self, channel):
+        # Parked indefinitely, so on a connection without a socket timeout
+        pubsub = self.redis_blocking.pubsub()
+        try:
+            pubsub.subscribe(channel)
+            for message in pubsub.listen():
+                if message["type"] == "subscribe":
+                    yield None
+                elif message["type"] == "message":
+                    yield message["data"]
+        finally:
+            pubsub.close()
+
+    def watch_pointer(self):
+        for k in self._subscribe(self.pointer_channel):
+            yield int(k) if k else None
+
+    def save_checkpoint(self, k, encoded, ts, delta=None):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(self._key("", k), encoded)
+        pipe.set(self._key("ts:", k), ts)
+        pipe.zadd(self.stamps, {k: ts})
+        if delta is not None:
+            pipe.set(self._key("delta:", k), delta)
+        else:
+            pipe.delete(self._key("delta:", k))
+        pipe.execute()
+
+    def copy_checkpoint(self, source, k, ts):
+        pipe = self.redis.pipeline(transaction=True)
+        if source == k:
+            pipe.exists(self._key("", k))
+        else:
+            pipe.copy(self._key("", source), self._key("", k), replace=True)
+        pipe.set(self._key("ts:", k), ts)
+        pipe.zadd(self.stamps, {k: ts})
+        pipe.delete(self._key("delta:", k))
+        (copied, *_) = pipe.execute()
+        return bool(copied)
+
+    def load_checkpoint(self, k):
+        return self.redis.get(self._key("", k))
+
+    def checkpoint_timestamp(self, k):
+        ts = self.redis.get(self._key("ts:", k))
+        return float(ts) if ts is not None else None
+
+    def checkpoint_delta(self, k):
+        return self.redis.get(self._key("delta:", k))
+
+    def checkpoint_stamps(self):
+        slots = [
+            int(x.replace(self._key("", ""), ""))
+            for x in self.redis.scan_iter(match=self._key("", "*"))
+        ]
+        if not slots:
+            return []
+        stamps = self.redis.mget([self._key("ts:", k) for k in slots])
+        return [
+            (k, float(ts) if ts is not None else -1)
+            for (k, ts) in zip(slots, stamps)
+        ]
+
+    def checkpoint_at(self, ts):
+        if not self.redis.exists(self.stamps):
+            # Written before there was an index
+            stamps = dict(self.checkpoint_stamps())
+            if not stamps:
+                return None
+            self.redis.zadd(self.stamps, stamps)
+        found = self.redis.zrevrangebyscore(
+            self.stamps, ts, "-inf", start=0, num=1
+        )
+        return int(found[0]) if found else None
+
+    def append_command(self, encoded, lane=INTERACTIVE):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.xadd(self.streams[lane], {"data": encoded})
+        pipe.incr(self.submitted)
+        pipe.get(self.processed)
+        (entry_id, submitted, processed) = pipe.execute()
+        if submitted - int(processed or 0) <= 1:
+            # Nothing else was pending, so the worker is only behind from now
+            self.redis.set(self.pending_at, time.time())
+        return entry_id
+
+    def read_commands(self, lasts):
+        streams = {
+            self.streams[lane]: last for (lane, last) in lasts.items()
+        }
+        result = self.redis_blocking.xread(streams=streams, block=0)
+        return [
+            (self.lanes[stream], entry_id, entry["data"])
+            for (stream, entries) in result
+            for (entry_id, entry) in entries
+        ]
+
+    def command_log(self):
+        return [
+            (lane, entry_id, entry["data"])
+            for (lane, stream) in self.streams.items()
+            for (entry_id, entry) in self.redis.xrange(stream)
+        ]
+
+    def start_consuming(self):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.get(self.submitted)
+        for stream in self.streams.values():
+            pipe.xrevrange(stream, count=1)
+        (submitted, *newest) = pipe.execute()
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(self.processed, submitted or 0)
+        pipe.set(self.processed_at, time.time())
+        pipe.execute()
+        return {
+            lane: entries[0][0] if entries else "0"
+            for (lane, entries) in zip(self.streams, newest)
+        }
+
+    def queue_status(self):
+        keys = [self.submitted, self.processed, self.processed_at]
+        (submitted, processed, processed_at, pending_at) = self.redis.mget(
+            keys + [self.pending_at]
+        )
+        depth = int(submitted or 0) - int(processed or 0)
+        return (
+            max(depth, 0),
+            float(processed_at) if processed_at is not None else None,
+            float(pending_at) if pending_at is not None else None,
+        )
+
+    def store_result(self, key, encoded, ttl):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(key, encoded, ex=ttl)
+        pipe.incr(self.processed)
+        pipe.set(self.processed_at, time.time())
+        pipe.publish(self.results_channel, key)
+        pipe.execute()
+
+    def load_result(self, key):
+        return self.redis.get(key)
+
+    def watch_results(self):
+        return self._subscribe(self.results_channel)
+
+    def undo_predecessor(self, k):
+        found = self.redis.hget(self.undo_predecessors, k)
+        return int(found) if found is not None else None
+
+    def set_undo_predecessor(self, k, predecessor):
+        self.redis.hset(self.undo_predecessors, k, predecessor)
+
+    def _history_key(self, name):
+        return f"{self.prefix}entity-history:{name}"
+
+    def append_history(self, records):
+        pipe = self.redis.pipeline(transaction=True)
+        for (name, encoded) in records:
+            pipe.rpush(self._history_key(name), encoded)
+        pipe.execute()
+
+    def entity_history(self, name):
+        return self.redis.lrange(self._history_key(name), 0, -1)
+
+    def reset(self):
+        for k in self.redis.keys():
+            self.redis.delete(k)
+        self.redis.publish(self.pointer_channel, "")
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Storage in an embedded SQLite database, in WAL mode so that readers never
+    wait for the writer.
+
+    Each thread gets its own connection.  Waiting for commands polls, backing
+    off to `max_poll` seconds between polls while the queue is idle.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            slot INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            ts REAL NOT NULL,
+            delta TEXT
+        );
+        CREATE TABLE IF NOT EXISTS commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data TEXT NOT NULL,
+            lane TEXT NOT NULL DEFAULT 'interactive'
+        );
+        CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS results_expires ON results (expires);
+        CREATE INDEX IF NOT EXISTS checkpoints_ts ON checkpoints (ts);
+        CREATE TABLE IF NOT EXISTS entity_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entity_history_entity
+            ON entity_history (entity, id);
+    """
+
+    def __init__(self, path, min_poll=0.001, max_poll=0.05):
+        self.path = path
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.local = threading.local()
+        self.db.executescript(self.schema)
+        columns = self.db.execute("PRAGMA table_info(commands)").fetchall()
+        if "lane" not in [column[1] for column in columns]:
+            # Created before there were lanes
+            self.db.execute(
+                "ALTER TABLE commands "
+                "ADD COLUMN lane TEXT NOT NULL DEFAULT 'interactive'"
+            )
+
+    @property
+    def db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    @contextmanager
+    def transaction(self):
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        else:
+            db.execute("COMMIT")
+
+    def _one(self, query, *args):
+        row = self.db.execute(query, args).fetchone()
+        return row[0] if row is not None else None
+
+    def get_pointer(self):
+        k = self._one("SELECT value FROM meta WHERE key = 'pointer'")
+        return int(k) if k is not None else None
+
+    def set_pointer(self, k):
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('pointer', ?)",
+            (str(k),),
+        )
+
+    def save_checkpoint(self, k, encoded, ts, delta=None):
+        self.db.execute(
+            "INSERT OR REPLACE INTO checkpoints (slot, data, ts, delta) "
+            "VALUES (?, ?, ?, ?)",
+            (k, encoded, ts, delta),
+        )
+
+    def copy_checkpoint(self, source, k, ts):
+        if source == k:
+            cursor = self.db.execute(
+                "UPDATE checkpoints SET ts = ?, delta = NULL WHERE slot = ?",
+                (ts, k),
+            )
+        else:
+            cursor = self.db.execute(
+                "INSERT OR REPLACE INTO checkpoints (slot, data, ts, delta) "
+                "SELECT ?, data, ?, NULL FROM checkpoints WHERE slot = ?",
+                (k, ts, source),
+            )
+        return cursor.rowcount > 0
+
+    def load_checkpoint(self, k):
+        return self._one("SELECT data FROM checkpoints WHERE slot = ?", k)
+
+    def checkpoint_timestamp(self, k):
+        return self._one("SELECT ts FROM checkpoints WHERE slot = ?", k)
+
+    def checkpoint_delta(self, k):
+        return self._one("SELECT delta FROM checkpoints WHERE slot = ?", k)
+
+    def checkpoint_stamps(self):
+        return self.db.execute("SELECT slot, ts FROM checkpoints").fetchall()
+
+    def checkpoint_at(self, ts):
+        return self._one(
+            "SELECT slot FROM checkpoints WHERE ts <= ? "
+            "ORDER BY ts DESC LIMIT 1",
+            ts,
+        )
+
+    def append_command(self, encoded, lane=INTERACTIVE):
+        with self.transaction() as db:
+            (depth,) = db.execute(self._depth).fetchone()
+            cursor = db.execute(
+                "INSERT INTO commands (data, lane) VALUES (?, ?)",
+                (encoded, lane),
+            )
+            if depth <= 0:
+                # Nothing else was pending, so the worker is only behind from
+                # now
+                self._set_meta(db, "pending-at", time.time())
+        return str(cursor.lastrowid)
+
+    def _commands_after(self, lasts):
+        # Ids are shared between the lanes, so one scan covers them all
+        return [
+            (lane, str(entry_id), data)
+            for (lane, entry_id, data) in self.db.execute(
+                "SELECT lane, id, data FROM commands WHERE id > ? ORDER BY id",
+                (min(int(last) for last in lasts.values()),),
+            )
+            if lane in lasts and entry_id > int(lasts[lane])
+        ]
+
+    def read_commands(self, lasts):
+        delay = self.min_poll
+        while True:
+            found = self._commands_after(lasts)
+            if found:
+                return found
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_poll)
+
+    def command_log(self):
+        return self._commands_after(dict.fromkeys(LANES, 0))
+
+    def _set_meta(self, db, key, value):
+        db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, str(value)),
+        )
+
+    def start_consuming(self):
+        with self.transaction() as db:
+            newest = db.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM commands"
+            ).fetchone()[0]
+            self._set_meta(db, "processed", newest)
+            self._set_meta(db, "processed-at", time.time())
+        return dict.fromkeys(LANES, str(newest))
+
+    _depth = (
+        "SELECT (SELECT COALESCE(MAX(id), 0) FROM commands) - COALESCE("
+        "(SELECT value FROM meta WHERE key = 'processed'), 0)"
+    )
+
+    def queue_status(self):
+        (depth, processed_at, pending_at) = self.db.execute(
+            "SELECT "
+            f"({self._depth}), "
+            "(SELECT value FROM meta WHERE key = 'processed-at'), "
+            "(SELECT value FROM meta WHERE key = 'pending-at')"
+        ).fetchone()
+        return (
+            max(int(depth), 0),
+            float(processed_at) if processed_at is not None else None,
+            float(pending_at) if pending_at is not None else None,
+        )
+
+    def store_result(self, key, encoded, ttl):
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("DELETE FROM results WHERE expires < ?", (now,))
+            db.execute(
+                "INSERT OR REPLACE INTO results (key, data, expires) "
+                "VALUES (?, ?, ?)",
+                (key, encoded, now + ttl),
+            )
+            db.execute(
+                "UPDATE meta SET value = CAST(value AS INTEGER) + 1 "
+                "WHERE key = 'processed'"
+            )
+            self._set_meta(db, "processed-at", now)
+
+    def load_result(self, key):
+        return self._one(
+            "SELECT data FROM results WHERE key = ? AND expires >= ?",
+            key,
+            time.time(),
+        )
+
+    def undo_predecessor(self, k):
+        found = self._one("SELECT value FROM meta WHERE key = ?", f"undo-{k}")
+        return int(found) if found is not None else None
+
+    def set_undo_predecessor(self, k, predecessor):
+        self._set_meta(self.db, f"undo-{k}", predecessor)
+
+    def append_history(self, records):
+        with self.transaction() as db:
+            db.executemany(
+                "INSERT INTO entity_history (entity, data) VALUES (?, ?)",
+                records,
+            )
+
+    def entity_history(self, name):
+        return [
+            data
+            for (data,) in self.db.execute(
+                "SELECT data FROM entity_history WHERE entity = ? "
+                "ORDER BY id",
+                (name,),
+            )
+        ]
+
+    def reset(self):
+        tables = (
+            "meta",
+            "checkpoints",
+            "commands",
+            "results",
+            "entity_history",
+        )
+        with self.transaction() as db:
+            for table in tables:
+                db.execute(f"DELETE FROM {table}")
+
+
+def make_backend(kind=None):
+    kind = kind or os.environ.get("STORAGE_BACKEND", "redis")
+    if kind == "redis":
+        return RedisBackend()
+    elif kind == "sqlite":
+        return SqliteBackend(os.environ.get("SQLITE_PATH", "storage.sqlite3"))
+    else:
+        raise ValueError(f"Unknown STORAGE_BACKEND '{kind}'")
+
+
+backend = make_backend()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+
+# Storage is chosen when `main_loop` is imported
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "test.sqlite3")
+
+import database
+from main_loop import process_command
+
+
+def test_has_aspect_selects_only_entities_with_it():
+    database.reset()
+    for name in ("A", "B", "C"):
+        process_command({"command": "create_entity", "name": name})
+    process_command(
+        {"command": "add_aspect", "entity": "A", "name": "On Fire"}
+    )
+    result = process_command(
+        {
+            "command": "bulk_set_fp",
+            "select": {"has_aspect": "on fire"},
+            "fp": 5,
+        }
+    )
+    assert list(result["result"]) == ["A"]
+    entities = database.read(database.get_checkpoint())["entities"]
+    assert {n: e["fate"] for (n, e) in entities.items()} == {
+        "A": 5,
+        "B": 0,
+        "C": 0,
+    }
+
+
+def test_lowering_max_clears_boxes_past_it():
+    database.reset()
+    process_command(
+        {
+            "command": "create_entity",
+            "name": "A",
+            "stress_maxes": {"physical": 3},
+        }
+    )
+    result = process_command(
+        {
+            "command": "add_stress",
+            "entity": "A",
+            "stress": "physical",
+            "box": 3,
+        }
+    )
+    assert result["result"]["stress"]["physical"]["checked"] == [3]
+    process_command(
+        {
+            "command": "edit_entity",
+            "name": "A",
+            "stress_maxes": {"physical": 2},
+        }
+    )
+    entity = database.read(database.get_checkpoint())["entities"]["A"]
+    assert entity["stress"]["physical"] == {"checked": [], "max": 2}
@@ -0,0 +1,22 @@
+from history import History
+
+
+def test_stale_base_snapshot_is_not_built_on():
+    history = History(3)
+    history.record(2, {"a": 1, "b": 0}, stamp=1.0)
+    # Slot 2 has since been rewritten with b = 9, at 5.0
+    snapshot = history.record(
+        0, {"a": 2, "b": 9}, changed=[("a",)], base=2, stamp=6.0,
+        base_stamp=5.0,
+    )
+    assert snapshot["b"] == 9
+
+
+def test_current_base_snapshot_is_shared():
+    history = History(3)
+    base = history.record(2, {"a": 1, "b": {"c": 0}}, stamp=1.0)
+    snapshot = history.record(
+        0, {"a": 2, "b": {"c": 0}}, changed=[("a",)], base=2, stamp=2.0,
+        base_stamp=1.0,
+    )
+    assert snapshot["b"] is base["b"]
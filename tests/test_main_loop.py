@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+# Storage is chosen when `main_loop` is imported
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "test.sqlite3")
+
+import database
+from main_loop import process_command
+from main_loop import run_coalesced
+
+
+def add_stress(entity, box):
+    return {
+        "command": "add_stress",
+        "entity": entity,
+        "stress": "physical",
+        "box": box,
+    }
+
+
+def test_handler_exceptions_are_the_result():
+    database.reset()
+    result = process_command(add_stress("Nobody", 1))
+    assert result["ok"] is False
+    assert result["exception"] == "KeyError"
+
+
+def test_coalesced_failures_fall_back_to_one_at_a_time():
+    database.reset()
+    process_command(
+        {
+            "command": "create_entity",
+            "name": "A",
+            "stress_maxes": {"physical": 3},
+        }
+    )
+    results = run_coalesced([add_stress("A", 1), add_stress("Nobody", 1)])
+    assert [r["ok"] for r in results] == [True, False]
+    entity = database.read(database.get_checkpoint())["entities"]["A"]
+    assert entity["stress"]["physical"]["checked"] == [1]
@@ -0,0 +1,62 @@
+import pytest
+
+from models import Game
+from models import InvalidState
+from models import StressTrack
+
+
+STATE = {
+    "entities": {
+        "Rayne": {
+            "name": "Rayne",
+            "fate": 3,
+            "refresh": 2,
+            "aspects": [
+                {"name": "On Fire", "kind": "mild", "tags": ["x"], "y": 1},
+            ],
+            "stress": {"physical": {"checked": [1, 3], "max": 3}},
+            "is_pc": True,
+            "portrait": "rayne.png",
+            "notes": "kept",
+        },
+        "Mook": {"stress": {"mental": {"max": 2}}},
+    },
+    "scene": "kept too",
+}
+
+
+def test_state_round_trips():
+    assert Game.from_json(STATE).to_json() == STATE
+
+
+def test_boxes_past_max_are_dropped():
+    track = StressTrack.from_json({"checked": [1, 3], "max": 2})
+    assert track.to_json() == {"checked": [1], "max": 2}
+
+
+def test_resize_clears_boxes_past_max():
+    track = StressTrack.from_json({"checked": [1, 3], "max": 3})
+    track.resize(2)
+    assert track.to_json() == {"checked": [1], "max": 2}
+
+
+@pytest.mark.parametrize(
+    "state",
+    [
+        ["A"],
+        {"entities": []},
+        {"entities": {"A": []}},
+        {"entities": {"A": {"aspects": ["On Fire"]}}},
+        {"entities": {"A": {"aspects": [{"kind": "mild"}]}}},
+        {"entities": {"A": {"aspects": {}}}},
+        {"entities": {"A": {"stress": []}}},
+        {"entities": {"A": {"stress": {"physical": []}}}},
+        {"entities": {"A": {"stress": {"physical": {"max": "3"}}}}},
+        {"entities": {"A": {"stress": {"p": {"checked": [True], "max": 3}}}}},
+        {"entities": {"A": {"fate": "3"}}},
+        {"entities": {"A": {"refresh": 1.5}}},
+    ],
+)
+def test_invalid_states_are_rejected(state):
+    with pytest.raises(InvalidState):
+        Game.from_json(state)
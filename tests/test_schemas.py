@@ -0,0 +1,29 @@
+import pytest
+
+from schemas import SchemaError
+from schemas import StressBox
+from schemas import CreateEntity
+from schemas import BulkSetFp
+from schemas import decode
+
+
+def test_int_fields_reject_fractions():
+    with pytest.raises(SchemaError):
+        decode(StressBox, {"entity": "A", "stress": "physical", "box": 2.9})
+    args = {"entity": "A", "stress": "physical", "box": 2.0}
+    assert decode(StressBox, args).box == 2
+
+
+def test_bool_fields_take_bools_and_strings_only():
+    assert decode(CreateEntity, {"name": "A", "is_pc": "yes"}).is_pc is True
+    with pytest.raises(SchemaError):
+        decode(CreateEntity, {"name": "A", "is_pc": [1]})
+    with pytest.raises(SchemaError):
+        decode(CreateEntity, {"name": "A", "is_pc": 1})
+
+
+def test_unexpected_fields_are_reported():
+    with pytest.raises(SchemaError, match="'x'"):
+        decode(StressBox, {"entity": "A", "stress": "p", "box": 1, "x": 1})
+    with pytest.raises(SchemaError, match="typo"):
+        decode(BulkSetFp, {"select": {"typo": True}, "fp": 1})
@@ -0,0 +1,143 @@
+#
+# Tracing commands through the system
+#
+# Each command is given a trace id when the HTTP tier queues it, and the id
+# travels with the command in its stream entry.  Each stage the command goes
+# through records a span in its trace: when the stage started, and how long
+# it took.  So a slow command can be pinned on litestar, the wait in the
+# stream, the wait for the writer, the handler, or the write to storage.
+#
+# The worker stores the trace with the command's result, and the HTTP tier
+# hands it back when asked, and appends it to `trace_file` if set.
+#
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import os
+import time
+import uuid
+
+
+# Finished traces are appended here, one JSON object per line, if set
+trace_file = os.environ.get("TRACE_FILE")
+
+# The trace of the command being run, if it has one
+current = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """
+    The spans recorded for one command, in the order they ended.
+
+    Times are Unix timestamps, since the spans are recorded by different
+    processes.
+    """
+
+    def __init__(self, trace_id=None, spans=()):
+        self.id = trace_id or uuid.uuid4().hex
+        self.spans = list(spans)
+
+    @property
+    def end(self):
+        """
+        When the last span ended, or None if there are none yet.
+        """
+        if not self.spans:
+            return None
+        last = self.spans[-1]
+        return last["start"] + last["ms"] / 1000
+
+    def add(self, name, start, end=None, **fields):
+        if end is None:
+            end = time.time()
+        if start is None:
+            start = end
+        ms = round(max(end - start, 0) * 1000, 3)
+        self.spans.append({"name": name, "start": start, "ms": ms, **fields})
+
+    @contextmanager
+    def span(self, name, **fields):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, **fields)
+
+    def to_json(self):
+        return {"id": self.id, "spans": self.spans}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data.get("id"), data.get("spans", ()))
+
+
+@contextmanager
+def span(name, **fields):
+    """
+    Record a span in the `current` trace, if there is one.
+    """
+    trace = current.get()
+    if trace is None:
+        yield
+    else:
+        with trace.span(name, **fields):
+            yield
+
+
+def carried(command, trace):
+    """
+    Return `command` as it should be put in the stream, carrying `trace`.
+    """
+    return {**command, "trace": {**trace.to_json(), "sent": time.time()}}
+
+
+def received(command):
+    """
+    Take the trace carried by `command`, as read from the stream, recording
+    the time it spent there.  Returns None if it carries none.
+    """
+    data = command.pop("trace", None) if isinstance(command, dict) else None
+    if not isinstance(data, dict):
+        return None
+    trace = Trace.from_json(data)
+    trace.add("stream", data.get("sent"))
+    return trace
+
+
+def attach(result, trace):
+    """
+    Return `result` as it should be stored, with `trace`.
+    """
+    if trace is None or not isinstance(result, dict):
+        return result
+    return {**result, "trace": trace.to_json()}
+
+
+def detach(result):
+    """
+    Split a stored result into the result and its trace, or None.
+    """
+    if not isinstance(result, dict) or "trace" not in result:
+        return (result, None)
+    result = dict(result)
+    return (result, Trace.from_json(result.pop("trace")))
+
+
+def export(trace, **fields):
+    """
+    Append `trace` to `trace_file`, if set, along with `fields`.
+    """
+    if not trace_file:
+        return
+    line = json.dumps({"id": trace.id, **fields, "spans": trace.spans})
+    # Each line is appended in a single write, so that several processes can
+    # share the file
+    try:
+        fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, (line + "\n").encode())
+        finally:
+            os.close(fd)
+    except OSError as err:
+        print(f"tracing | failed to export {trace.id}: {err!r}")
@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+
+from utils import UNSET
+
+
+class ChangeLog:
+    """
+    Record of which paths in the live state were modified during an edit.
+
+    The model classes report their own mutations here, so the commit path
+    can tell that nothing changed without comparing whole states, and can
+    store the changed paths alongside the checkpoint.  Nothing is recorded
+    outside of `recording()`, e.g. while models are being built from JSON.
+    """
+
+    def __init__(self):
+        self.paths = None
+
+    def mark(self, path):
+        if self.paths is not None and path is not None:
+            self.paths.add(path)
+
+    @contextmanager
+    def recording(self):
+        paths = set()
+        self.paths = paths
+        try:
+            yield paths
+        finally:
+            self.paths = None
+
+
+changes = ChangeLog()
+
+
+class TrackedDict(dict):
+    """
+    A dict which reports key assignments and removals to `changes`.
+
+    Values with an `attach` method are told their path when stored, so that
+    they can report their own mutations.
+    """
+
+    __slots__ = ("path",)
+
+    def __init__(self, path, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.attach(path)
+
+    def attach(self, path):
+        self.path = path
+        for (key, value) in self.items():
+            _attach(value, self._child(key))
+
+    def _child(self, key):
+        return None if self.path is None else self.path + (key,)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        _attach(value, self._child(key))
+        changes.mark(self._child(key))
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        changes.mark(self._child(key))
+
+    def pop(self, key, *default):
+        if key in self:
+            changes.mark(self._child(key))
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in self:
+            changes.mark(self._child(key))
+        super().clear()
+
+    def popitem(self):
+        (key, value) = super().popitem()
+        changes.mark(self._child(key))
+        return (key, value)
+
+
+def _attach(value, path):
+    attach = getattr(value, "attach", None)
+    if attach is not None:
+        attach(path)
+
+
+def tracked_setattr(self, name, value):
+    """
+    `__setattr__` for slotted model classes with a `path` slot.
+
+    Marks the attribute's JSON path as changed when an already-set attribute
+    gets a different value.  Classes may rename attributes to their JSON key
+    with a `json_names` mapping; a name mapped to None marks the object's own
+    path.  Setting `path` itself is never recorded.
+    """
+    if name != "path":
+        old = getattr(self, name, UNSET)
+        if old is not UNSET and old != value:
+            path = getattr(self, "path", None)
+            if path is not None:
+                key = self.json_names.get(name, name)
+                changes.mark(path if key is None else path + (key,))
+    object.__setattr__(self, name, value)